@@ -2,20 +2,30 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
 from trytond.pool import Pool
+from . import attachment
+from . import ir
 from . import product
 from . import magento_core
 from . import menu
+from . import price_list
 from . import shop
 
 def register():
     Pool.register(
         magento_core.MagentoApp,
+        magento_core.MagentoExternalReferential,
         magento_core.MagentoSaleShopGroupPrice,
+        magento_core.MagentoFingerprint,
         product.MagentoProductType,
         product.MagentoAttributeConfigurable,
         menu.CatalogMenu,
         product.Template,
         product.TemplateMagentoAttributeConfigurable,
+        product.MagentoProductMap,
+        product.MagentoProductOutbox,
         product.Product,
         shop.SaleShop,
+        attachment.Attachment,
+        ir.Cron,
+        price_list.PriceListLine,
         module='magento_product', type_='model')
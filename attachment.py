@@ -0,0 +1,53 @@
+# This file is part magento_product module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from trytond.model import fields
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['Attachment']
+
+
+class Attachment(metaclass=PoolMeta):
+    __name__ = 'ir.attachment'
+    magento_etag = fields.Char('Magento ETag', readonly=True,
+        help='ETag of the last image downloaded from Magento')
+    magento_last_modified = fields.Char('Magento Last Modified',
+        readonly=True,
+        help='Last-Modified of the last image downloaded from Magento')
+    magento_digest = fields.Char('Magento Digest', readonly=True, select=True,
+        help='MD5 digest of the last image downloaded from Magento')
+
+    @classmethod
+    def copy(cls, attachments, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        default.setdefault('magento_etag', None)
+        default.setdefault('magento_last_modified', None)
+        return super(Attachment, cls).copy(attachments, default=default)
+
+    @classmethod
+    def create(cls, vlist):
+        attachments = super(Attachment, cls).create(vlist)
+        cls.magento_enqueue(attachments)
+        return attachments
+
+    @classmethod
+    def write(cls, *args):
+        super(Attachment, cls).write(*args)
+        cls.magento_enqueue(sum(args[0:None:2], []))
+
+    @classmethod
+    def magento_enqueue(cls, attachments):
+        '''Add the products of the attachments to the Magento outbox
+        (images)'''
+        Outbox = Pool().get('magento.product.outbox')
+        products = []
+        for attachment in attachments:
+            resource = attachment.resource
+            model = getattr(resource, '__name__', None)
+            if model == 'product.template':
+                products.extend(resource.products)
+            elif model == 'product.product':
+                products.append(resource)
+        Outbox.enqueue(products, ['image'])
@@ -2,19 +2,36 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
 from creole import creole2html
-from trytond.model import ModelSQL, ModelView, fields
+from trytond.model import ModelSQL, ModelView, fields, Unique
 from trytond.pool import Pool, PoolMeta
 from trytond.transaction import Transaction
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
+from trytond.tools import grouped_slice
+from trytond.config import config as config_
+from trytond.filestore import filestore
 from trytond.modules.product_esale.tools import slugify, seo_lenght
+from .tools import (magento_api, magento_imap, magento_multicall,
+    magento_download, fingerprint, chunks, DOWNLOAD_WORKERS)
 from magento import *
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+import hashlib
+import json
 import logging
-from urllib.request import urlopen
+import threading
 
-__all__ = ['MagentoApp', 'MagentoSaleShopGroupPrice']
+__all__ = ['MagentoApp', 'MagentoExternalReferential',
+    'MagentoSaleShopGroupPrice', 'MagentoFingerprint']
 
+IMPORT_WINDOW = config_.getint('magento', 'import_window', default=100)
+IMPORT_BATCH = config_.getint('magento', 'import_batch', default=25)
 _ATTRIBUTE_OPTIONS_TYPE = ['select']
+_CATEGORY_FINGERPRINT = ['name', 'url_key', 'description', 'meta_description',
+    'meta_keywords', 'meta_title', 'default_sort_by', 'is_active']
+_REFERENTIAL_CACHE = threading.local()
 logger = logging.getLogger(__name__)
 
 
@@ -41,6 +58,9 @@ class MagentoApp(metaclass=PoolMeta):
     top_menu = fields.Many2One('esale.catalog.menu', 'Top Menu')
     wikimarkup = fields.Boolean('Wikimarkup',
         help='Parser text markup (Wiki)')
+    multicall_size = fields.Integer('MultiCall Size',
+        help='Number of updates sent in a Magento multiCall request '
+            '(0 or 1 to send one request by update)')
 
     @classmethod
     def __setup__(cls):
@@ -63,6 +83,10 @@ class MagentoApp(metaclass=PoolMeta):
     def default_wikimarkup():
         return True
 
+    @staticmethod
+    def default_multicall_size():
+        return 50
+
     @classmethod
     @ModelView.button
     def core_import_product_type(self, apps):
@@ -71,7 +95,7 @@ class MagentoApp(metaclass=PoolMeta):
         """
         ProductType = Pool().get('magento.product.type')
         for app in apps:
-            with ProductTypes(app.uri,app.username,app.password) as product_type_api:
+            with magento_api(app, ProductTypes) as product_type_api:
                 for product_type in product_type_api.list():
                     prod_types = ProductType.search([
                         ('code','=',product_type['type']),
@@ -100,46 +124,41 @@ class MagentoApp(metaclass=PoolMeta):
         """Import Magento Group Attributes to Tryton
         Only create new groups; not update or delete
         """
-        ExternalReferential = Pool().get('magento.external.referential')
-        AttrGroup = Pool().get('esale.attribute.group')
-        to_create = []
-        attribute_sets = []
+        pool = Pool()
+        ExternalReferential = pool.get('magento.external.referential')
+        AttrGroup = pool.get('esale.attribute.group')
+
+        to_create = {}
+        external_ids = {}
         for app in apps:
-            with ProductAttributeSet(app.uri,app.username,app.password) as \
+            with magento_api(app, ProductAttributeSet) as \
                     product_attribute_set_api:
-                for product_attribute_set in product_attribute_set_api.list():
-                    attribute_set = ExternalReferential.get_mgn2try(
-                        app,
-                        'esale.attribute.group',
-                        product_attribute_set['set_id'],
-                        )
-
-                    if not attribute_set: #create
-                        to_create.append({
-                            'name': product_attribute_set['name'],
-                            'code': product_attribute_set['name'],
-                            })
-                        attribute_sets.append({
-                            'name': product_attribute_set['name'],
-                            'code': product_attribute_set['name'],
-                            'id': product_attribute_set['set_id']
-                            })
-                    else:
-                        logger.info(
-                            'Skip! Attribute Group exists: APP %s, Attribute %s.' % (
-                                app.name,
-                                product_attribute_set['set_id'],
-                                ))
+                product_attribute_sets = product_attribute_set_api.list()
+
+            attribute_sets = ExternalReferential.get_mgn2try_ids(app,
+                'esale.attribute.group',
+                [s['set_id'] for s in product_attribute_sets])
+            for product_attribute_set in product_attribute_sets:
+                if str(product_attribute_set['set_id']) in attribute_sets:
+                    logger.info(
+                        'Skip! Attribute Group exists: APP %s, Attribute %s.' % (
+                            app.name,
+                            product_attribute_set['set_id'],
+                            ))
+                    continue
+
+                key = (app, product_attribute_set['name'])
+                to_create[key] = {
+                    'name': product_attribute_set['name'],
+                    'code': product_attribute_set['name'],
+                    }
+                external_ids[key] = product_attribute_set['set_id']
 
         if to_create:
-            attribute_groups = AttrGroup.create(to_create)
-            for attribute_group in attribute_groups:
-                for attribute in attribute_sets:
-                    if attribute.get('code') == attribute_group.code:
-                        external_id = attribute.get('id')
-                        break
-                if not external_id:
-                    continue
+            keys = list(to_create.keys())
+            attribute_groups = AttrGroup.create([to_create[k] for k in keys])
+            for (app, _), attribute_group in zip(keys, attribute_groups):
+                external_id = external_ids[(app, attribute_group.code)]
                 ExternalReferential.set_external_referential(
                     app,
                     'esale.attribute.group',
@@ -162,42 +181,53 @@ class MagentoApp(metaclass=PoolMeta):
         AttrGroup = pool.get('esale.attribute.group')
         ExternalReferential = pool.get('magento.external.referential')
 
+        groups = AttrGroup.search([])
         for app in apps:
-            groups = AttrGroup.search([])
-            for group in groups:
-                attr_external = ExternalReferential.get_try2mgn(app,
-                        'esale.attribute.group', group.id)
-                if attr_external:
-                    with ProductAttribute(app.uri, app.username, app.password) as \
-                            product_attribute_api:
-                        attributes = product_attribute_api.list(attr_external.mgn_id)
-
-                        for attribute in attributes:
-                            if attribute.get('type') not in _ATTRIBUTE_OPTIONS_TYPE:
-                                continue
-                            attrs = Attribute.search([
-                                ('name', '=', attribute.get('code'))
-                                ], limit=1)
-                            if not attrs:
-                                continue
-
-                            attr, = attrs
-                            if attribute.get('type') == 'select':
-                                options = product_attribute_api.options(attr.name)
-                                opt = []
-                                for option in options:
-                                    if not option.get('value'):
-                                        continue
-                                    opt.append('%s:%s' % (
-                                            option.get('value'),
-                                            option.get('label'),
-                                            ))
-                                if opt:
-                                    Attribute.write([attr], {
-                                        'selection': '\n'.join(opt),
-                                        })
-                                    logger.info(
-                                        'Save attribute options %s' % (attr.name))
+            set_ids = list(ExternalReferential.get_try2mgn_ids(app,
+                    'esale.attribute.group', [g.id for g in groups]).values())
+
+            # distinct select attributes of all attribute sets
+            codes = set()
+            for attributes in magento_imap(app, ProductAttribute,
+                    lambda api, set_id: api.list(set_id), set_ids):
+                for attribute in attributes:
+                    if attribute.get('type') not in _ATTRIBUTE_OPTIONS_TYPE:
+                        continue
+                    codes.add(attribute.get('code'))
+
+            attrs = {}
+            for sub_codes in grouped_slice(list(codes)):
+                for attr in Attribute.search([
+                        ('name', 'in', list(sub_codes)),
+                        ]):
+                    attrs.setdefault(attr.name, attr)
+
+            # fetch options once by attribute and write only changes
+            names = sorted(attrs.keys())
+            to_write = []
+            for name, options in zip(names, magento_imap(app, ProductAttribute,
+                        lambda api, name: api.options(name), names)):
+                attr = attrs[name]
+                opt = []
+                for option in options:
+                    if not option.get('value'):
+                        continue
+                    opt.append('%s:%s' % (
+                            option.get('value'),
+                            option.get('label'),
+                            ))
+                if not opt:
+                    continue
+                selection = '\n'.join(opt)
+                if attr.selection == selection:
+                    continue
+                to_write.extend(([attr], {
+                    'selection': selection,
+                    }))
+                logger.info(
+                    'Save attribute options %s' % (attr.name))
+            if to_write:
+                Attribute.write(*to_write)
 
         logger.info('End import attribute options')
 
@@ -277,41 +307,33 @@ class MagentoApp(metaclass=PoolMeta):
             'Update category %s (%s-%s)' % (data.get('name'), menu.id, language))
         return menu
 
-    @classmethod
-    def children_categories(self, app, parent, data):
+    @staticmethod
+    def magento_category_nodes(data):
         '''
-        Get recursive categories and create new categories
-        :param app: object
-        :param parent: id
-        :param data: dict
-        :return: True
+        Flat a Magento category tree: parents before children
+        :param data: dict (category tree)
+        :return: list of tuples (category id, parent category id)
         '''
-        Menu = Pool().get('esale.catalog.menu')
+        nodes = []
+        queue = deque([(data, None)])
+        while queue:
+            node, parent_id = queue.popleft()
+            category_id = node.get('category_id')
+            nodes.append((category_id, parent_id))
+            for children in node.get('children') or []:
+                queue.append((children, category_id))
+        return nodes
 
-        with Category(app.uri, app.username, app.password) as category_api:
-            for children in data.get('children'):
-                with Transaction().set_context(active_test=False):
-                    menus = Menu.search([
-                            ('magento_app', '=', app.id),
-                            ('magento_id', '=', children.get('category_id')),
-                            ], limit=1)
-
-                cat_info = category_api.info(children.get('category_id'))
-                if menus:
-                    menu, = menus
-                    app.save_menu(cat_info, parent, menu)
-                if not menus:
-                    menu = app.save_menu(cat_info, parent)
-
-                # save categories by language
-                for lang in app.languages:
-                    cat_info = category_api.info(cat_info.get('category_id'), store_view=lang.storeview.code)
-                    language = 'en_US' if lang.default else lang.lang.code #use default language to en_US
-                    self.save_menu_language(menu, cat_info, language=language)
-
-                if children.get('children'):
-                    data = category_api.tree(parent_id=children.get('category_id'))
-                    self.children_categories(app, menu.id, data)
+    @staticmethod
+    def magento_fetch_category(category_api, item):
+        '''
+        Fetch category info (run in threads: not use Tryton records)
+        :param category_api: Magento Category API
+        :param item: tuple (category id, store view code or None)
+        :return: dict
+        '''
+        category_id, store_view = item
+        return category_api.info(category_id, store_view=store_view)
 
     @classmethod
     @ModelView.button
@@ -319,7 +341,9 @@ class MagentoApp(metaclass=PoolMeta):
         """Import Magento Categories to Tryton
         Only create/update new categories; not delete
         """
-        Menu = Pool().get('esale.catalog.menu')
+        pool = Pool()
+        Menu = pool.get('esale.catalog.menu')
+        Fingerprint = pool.get('magento.fingerprint')
 
         for app in apps:
             logger.info(
@@ -327,26 +351,81 @@ class MagentoApp(metaclass=PoolMeta):
             if not app.category_root_id:
                 raise UserError(gettext('magento_product.msg_select_category_root'))
 
-            with Category(app.uri, app.username, app.password) as category_api:
+            # the tree is fetched once; details are fetched in parallel
+            with magento_api(app, Category) as category_api:
                 data = category_api.tree(parent_id=app.category_root_id)
-
-                with Transaction().set_context(active_test=False):
-                    category_roots = Menu.search([
+            nodes = self.magento_category_nodes(data)
+
+            store_views = [(lang.storeview.code,
+                    'en_US' if lang.default else lang.lang.code) #use default language to en_US
+                for lang in app.languages]
+            items = []
+            for category_id, _ in nodes:
+                items.append((category_id, None))
+                for store_view, _ in store_views:
+                    items.append((category_id, store_view))
+            infos = dict(zip(items, magento_imap(
+                        app, Category, self.magento_fetch_category, items)))
+
+            with Transaction().set_context(active_test=False):
+                menus = dict((menu.magento_id, menu) for menu in Menu.search([
                         ('magento_app', '=', app.id),
-                        ('magento_id', '=', data.get('category_id')),
-                        ], limit=1)
-
-                if not category_roots:
-                    root_info = category_api.info(data.get('category_id'))
-                    category_root = app.save_menu(root_info)
-                    category_root.active = True
-                    category_root.save()
-                else:
-                    category_root, = category_roots
+                        ('magento_id', '!=', None),
+                        ]))
+            fingerprints = Fingerprint.get_fingerprints(app,
+                [str(menu) for menu in menus.values()])
+            to_fingerprint = {}
+            counts = {'create': 0, 'update': 0, 'unchanged': 0}
+            lang_counts = {'update': 0, 'unchanged': 0}
+
+            # create/update categories: parents before children
+            for category_id, parent_id in nodes:
+                info = infos[(category_id, None)]
+                menu = menus.get(int(category_id))
+                if parent_id is None: # category root
+                    if not menu:
+                        menu = app.save_menu(info)
+                        menu.active = True
+                        menu.save()
+                    menus[int(category_id)] = menu
+                    continue
 
-                Transaction().commit()
-                self.children_categories(app, category_root.id, data)
+                parent = menus[int(parent_id)]
+                values = fingerprint([parent.id] +
+                    [info.get(k) for k in _CATEGORY_FINGERPRINT])
+                written = False
+                if menu and fingerprints.get((str(menu), 'default')) == values:
+                    counts['unchanged'] += 1
+                else:
+                    written = True
+                    counts['update' if menu else 'create'] += 1
+                    menu = app.save_menu(info, parent.id, menu)
+                    menus[int(category_id)] = menu
+                    to_fingerprint[(str(menu), 'default')] = values
+
+                # save categories by language (always when the default
+                # values are written: translations could be fuzzy)
+                for store_view, language in store_views:
+                    lang_info = infos[(category_id, store_view)]
+                    values = fingerprint(
+                        [lang_info.get(k) for k in _CATEGORY_FINGERPRINT])
+                    if (not written
+                            and fingerprints.get((str(menu), language))
+                            == values):
+                        lang_counts['unchanged'] += 1
+                        continue
+                    lang_counts['update'] += 1
+                    self.save_menu_language(menu, lang_info, language=language)
+                    to_fingerprint[(str(menu), language)] = values
+
+            Fingerprint.set_fingerprints(app, to_fingerprint)
 
+            logger.info(
+                'Import categories %s: %s created, %s updated, %s unchanged. '
+                'Translations: %s updated, %s unchanged.' % (
+                    app.name, counts['create'], counts['update'],
+                    counts['unchanged'], lang_counts['update'],
+                    lang_counts['unchanged']))
             logger.info('End import categories %s' % (app.name))
 
     @classmethod
@@ -396,7 +475,10 @@ class MagentoApp(metaclass=PoolMeta):
 
             menus = Menu.get_allchild(top_menu)
 
-            with Category(app.uri, app.username, app.password) as category_api:
+            # updates are sent by multiCall; creates are sent one by one
+            # because children need the Magento ID of the parent
+            calls = []
+            with magento_api(app, Category) as category_api:
                 for menu in menus:
                     magento_id = menu.magento_id
 
@@ -407,28 +489,29 @@ class MagentoApp(metaclass=PoolMeta):
                                 app.name, data)
                         logger.info(message)
 
-                    try:
-                        if magento_id:
-                            action = 'update'
-                            category_api.update(magento_id, data)
-                        else:
-                            action = 'create'
+                    if magento_id:
+                        calls.append((('catalog_category.update',
+                                    (magento_id, data, None)),
+                                (menu, None)))
+                    else:
+                        try:
                             parent_id = menu.parent.magento_id
-                            mgn_cat = category_api.create(parent_id, data, store_view)
+                            magento_id = category_api.create(parent_id, data, store_view)
                             Menu.write([menu], {
-                                    'magento_id': mgn_cat,
+                                    'magento_id': magento_id,
                                     'magento_app': app.id,
                                     })
+                            message = 'Magento %s. Create category: %s (%s)' % (
+                                    app.name, menu.name, menu.id)
+                            logger.info(message)
+                        except Exception as e:
+                            message = 'Magento %s. Error export category ID %s: %s' % (
+                                        app.name, menu.id, e)
+                            logger.error(message)
 
-                        message = 'Magento %s. %s category: %s (%s)' % (
-                                app.name, action.capitalize(), menu.name, menu.id)
-                        logger.info(message)
-                    except Exception as e:
-                        message = 'Magento %s. Error export category ID %s: %s' % (
-                                    app.name, menu.id, e)
-                        logger.error(message)
-
-                    Transaction().commit()
+                        Transaction().commit()
+                        if not magento_id:
+                            continue
 
                     # Export categories by languages
                     for lang in app.languages:
@@ -436,19 +519,30 @@ class MagentoApp(metaclass=PoolMeta):
                         with Transaction().set_context(language=language):
                             menu_lang = Menu(menu)
                             data = self.magento_category_values(menu_lang)
-
-                        try:
-                            magento_id = menu_lang.magento_id
-                            sview = lang.storeview.code
-
-                            category_api.update(magento_id, data, sview)
-                            message = 'Magento %s. Update category: %s (%s)' % (
-                                    app.name, menu.name, language)
-                            logger.info(message)
-                        except Exception as e:
-                            message = 'Magento %s. Error export category lang ID %s: %s' % (
-                                        app.name, menu.id, e)
-                            logger.error(message)
+                        calls.append((('catalog_category.update',
+                                    (magento_id, data, lang.storeview.code)),
+                                (menu, language)))
+
+                results = magento_multicall(category_api,
+                    [call for call, _ in calls], app.multicall_size)
+
+            for (_, (menu, language)), (ok, result) in zip(calls, results):
+                if ok and language:
+                    message = 'Magento %s. Update category: %s (%s)' % (
+                            app.name, menu.name, language)
+                    logger.info(message)
+                elif ok:
+                    message = 'Magento %s. Update category: %s (%s)' % (
+                            app.name, menu.name, menu.id)
+                    logger.info(message)
+                elif language:
+                    message = 'Magento %s. Error export category lang ID %s: %s' % (
+                                app.name, menu.id, result)
+                    logger.error(message)
+                else:
+                    message = 'Magento %s. Error export category ID %s: %s' % (
+                                app.name, menu.id, result)
+                    logger.error(message)
 
             logger.info('End import categories %s' % (app.name))
 
@@ -461,69 +555,114 @@ class MagentoApp(metaclass=PoolMeta):
         :param product: object
         :return: object
         '''
+        template, = self.save_products(app, [data], [product])
+        return template
+
+    @classmethod
+    def save_products(self, app, datas, products):
+        '''
+        Save a batch of products: menus and shops are resolved once by batch,
+        new templates are created with one call and updates are grouped by
+        values in one write call
+        :param app: object
+        :param datas: list of dict
+        :param products: list of objects or None (same order as datas)
+        :return: list of templates (same order as datas)
+        '''
         pool = Pool()
         Prod = pool.get('product.product')
         Template = pool.get('product.template')
         Menu = pool.get('esale.catalog.menu')
         Shop = pool.get('sale.shop')
 
-        # get values using base external mapping
-        vals = Prod.magento_import_product(data)
-
-        # Shops - websites
-        shops = Prod.magento_product_shops(app, data)
-        if not shops:
-            raise UserError(gettext('magento_product.msg_shop_not_found'))
-
-        shop = Shop(shops[0])
-        if shop.esale_uom_product:
-            default_uom = shop.esale_uom_product
-        else:
-            raise UserError(gettext('magento_product.msg_shop_without_default_uom'))
-
         # Categories -> menus
-        menus = Menu.search([
-                ('magento_app', '=', app),
-                ('magento_id', 'in', data.get('categories')),
-                ])
-
-        if app.debug:
-            logger.info('Product values: %s' % (dict(tvals.items() + pvals.items())))
-
-        if not product:
-            action = 'create'
-
-            # Taxes and list price and cost price with or without taxes
-            tax_include = app.tax_include
-            customer_taxes, list_price, cost_price = Prod.magento_product_esale_taxes(app, data, tax_include)
-            if customer_taxes:
-                vals['customer_taxes'] = [('add', customer_taxes)]
-            if not list_price:
-                list_price = data.get('price')
-            vals['list_price'] = list_price
-            if not cost_price:
-                cost_price = data.get('price')
-            vals['cost_price'] = cost_price
-            vals['shops'] = [('add', shops)]
-            vals['esale_menus'] = [('add', [menu for menu in menus])]
-            product = Template.create_esale_product(shop, vals)
-        else:
-            template = product.template
-            action = 'update'
-            if vals.get('type'):
-                del vals['type']
-            if vals.get('products'):
-                del vals['products']
-            vals['shops'] = shops
-            vals['esale_menus'] = [menu for menu in menus]
-            for key, value in vals.items():
-                setattr(template, key, value)
-            template.save()
-
-        logger.info('%s product %s (%s)' % (action.capitalize(),
-            product.rec_name, product.id))
-
-        return product
+        categories = set(int(c) for data in datas
+            for c in data.get('categories') or [])
+        menus = {}
+        for sub_categories in grouped_slice(list(categories)):
+            for menu in Menu.search([
+                    ('magento_app', '=', app),
+                    ('magento_id', 'in', list(sub_categories)),
+                    ]):
+                menus[menu.magento_id] = menu.id
+
+        shops_cache = {}
+        to_create = defaultdict(list)
+        to_write = {}
+        templates = [None] * len(datas)
+        for i, (data, product) in enumerate(zip(datas, products)):
+            # get values using base external mapping
+            vals = Prod.magento_import_product(data)
+
+            # Shops - websites
+            shops = Prod.magento_product_shops(app, data)
+            if not shops:
+                raise UserError(gettext('magento_product.msg_shop_not_found'))
+
+            shop = shops_cache.get(shops[0])
+            if not shop:
+                shop = shops_cache[shops[0]] = Shop(shops[0])
+            if not shop.esale_uom_product:
+                raise UserError(gettext('magento_product.msg_shop_without_default_uom'))
+
+            menu_ids = [menus[int(c)] for c in data.get('categories') or []
+                if int(c) in menus]
+
+            if app.debug:
+                logger.info('Product values: %s' % (vals))
+
+            if not product:
+                # Taxes and list price and cost price with or without taxes
+                tax_include = app.tax_include
+                customer_taxes, list_price, cost_price = Prod.magento_product_esale_taxes(app, data, tax_include)
+                if customer_taxes:
+                    vals['customer_taxes'] = [('add', customer_taxes)]
+                if not list_price:
+                    list_price = data.get('price')
+                vals['list_price'] = list_price
+                if not cost_price:
+                    cost_price = data.get('price')
+                vals['cost_price'] = cost_price
+                vals['shops'] = [('add', shops)]
+                vals['esale_menus'] = [('add', menu_ids)]
+                to_create[shop].append((i, vals))
+            else:
+                template = product.template
+                if vals.get('type'):
+                    del vals['type']
+                if vals.get('products'):
+                    del vals['products']
+                for name, ids in (('shops', shops), ('esale_menus', menu_ids)):
+                    current = set(r.id for r in getattr(template, name))
+                    vals[name] = []
+                    if current - set(ids):
+                        vals[name].append(
+                            ('remove', sorted(current - set(ids))))
+                    if set(ids) - current:
+                        vals[name].append(('add', sorted(set(ids) - current)))
+                # group templates with the same values
+                key = fingerprint(vals)
+                to_write.setdefault(key, ([], vals))[0].append(template)
+                templates[i] = template
+
+        for shop, values in to_create.items():
+            for (i, _), template in zip(values, Template.create_esale_products(
+                        shop, [vals for _, vals in values])):
+                templates[i] = template
+                logger.info('Create product %s (%s)' % (
+                    template.rec_name, template.id))
+
+        if to_write:
+            args = []
+            for records, vals in to_write.values():
+                args.extend((records, vals))
+            Template.write(*args)
+            for records, _ in to_write.values():
+                for template in records:
+                    logger.info('Update product %s (%s)' % (
+                        template.rec_name, template.id))
+
+        return templates
 
     @classmethod
     def save_product_language(self, app, template, data, language='en_US'):
@@ -535,20 +674,36 @@ class MagentoApp(metaclass=PoolMeta):
         :param language: code language
         :return: object
         '''
-        Product = Pool().get('product.product')
+        self.save_products_language(app, [template], [data], language)
+        return template
+
+    @classmethod
+    def save_products_language(self, app, templates, datas, language='en_US'):
+        '''
+        Save a batch of products by language with one write call
+        :param app: object
+        :param templates: list of objects
+        :param datas: list of dict (same order as templates)
+        :param language: code language
+        '''
+        pool = Pool()
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
 
-        vals = Product.magento_import_product(data)
-        del vals['products']
+        args = []
+        for template, data in zip(templates, datas):
+            vals = Product.magento_import_product(data)
+            del vals['products']
+            args.extend(([template], vals))
+        if not args:
+            return
 
         with Transaction().set_context(language=language):
-            for key, value in vals.items():
-                setattr(template, key, value)
-            template.save()
+            Template.write(*args)
 
+        for template, data in zip(templates, datas):
             logger.info('Update template %s (%s-%s)' % (data.get('name'), template.id, language))
 
-        return template
-
     @classmethod
     def save_product_images(self, app, template, code):
         '''
@@ -560,56 +715,285 @@ class MagentoApp(metaclass=PoolMeta):
         pool = Pool()
         Attachment = pool.get('ir.attachment')
 
-        with ProductImages(app.uri, app.username, app.password) as product_images_api:
-            for image in product_images_api.list(code):
+        with magento_api(app, ProductImages) as product_images_api:
+            mgn_images = product_images_api.list(code)
+
+        resource = '%s' % (template)
+        attachments = {}
+        for attachment in Attachment.search([
+                ('resource', '=', resource),
+                ]):
+            attachments.setdefault(attachment.name.lower(), attachment)
+
+        images = []
+        for image in mgn_images:
+            if 'url' in image: # magento = 1.3
+                url = image.get('url')
+            else: # magento > 1.4
+                url = image.get('filename')
+            if not url:
+                continue
+            name = url.split('/')[-1:][0]
+            images.append((image, url, name, attachments.get(name.lower())))
+        if not images:
+            return
+
+        # as the Binary field, files are stored with the field prefix or the
+        # database name
+        prefix = Attachment.data.store_prefix
+        if prefix is None:
+            prefix = Transaction().database.name
+        use_filestore = bool(Attachment.data.file_id)
+
+        def download(request):
+            # every image is hashed (and stored) as it is downloaded: the
+            # data is not kept in memory until all images are downloaded.
+            # The filestore ID is the digest of the data (files with the
+            # same data are stored once)
+            data, etag, last_modified = magento_download(*request)
+            if data is None:
+                return None, None, etag, last_modified
+            digest = hashlib.md5(data).hexdigest()
+            if use_filestore:
+                return digest, filestore.set(data, prefix=prefix), etag, \
+                    last_modified
+            return digest, data, etag, last_modified
+
+        # download images in parallel; not modified images return None
+        requests = [(url,
+                attachment.magento_etag if attachment else None,
+                attachment.magento_last_modified if attachment else None)
+            for _, url, _, attachment in images]
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+            downloads = list(executor.map(download, requests))
+
+        to_save = []
+        for (image, url, name, attachment), (digest, data, etag,
+                last_modified) in zip(images, downloads):
+            if attachment:
+                action = 'update'
+            else:
+                action = 'create'
+                attachment = Attachment()
+
+            exclude = False
+            if image.get('exclude') == '1':
+                exclude = True
+
+            base_image = False
+            small_image = False
+            thumbnail = False
+            if 'image' in image.get('types'):
+                base_image = True
+            if 'small_image' in image.get('types'):
+                small_image = True
+            if 'thumbnail' in image.get('types'):
+                thumbnail = True
+
+            if digest is not None:
+                if action == 'update' and attachment.magento_digest == digest:
+                    pass
+                elif use_filestore:
+                    attachment.file_id = data
+                else:
+                    attachment.data = data
+                attachment.magento_digest = digest
+                attachment.magento_etag = etag
+                attachment.magento_last_modified = last_modified
+
+            attachment.name = name
+            attachment.type = 'data'
+            attachment.resource = resource
+            attachment.description = image.get('label')
+            attachment.esale_available = True
+            attachment.esale_base_image = base_image
+            attachment.esale_small_image = small_image
+            attachment.esale_thumbnail = thumbnail
+            attachment.esale_exclude = exclude
+            attachment.esale_position = image.get('position')
+            to_save.append(attachment)
+
+            logger.info('%s image %s%s' % (action.capitalize(), name,
+                    ' (not modified)' if digest is None else ''))
+        Attachment.save(to_save)
+
+    @classmethod
+    def magento_products_by_code(self, codes):
+        '''
+        Index products by code: search products and templates (without
+        product code) in bulk
+        :param codes: list
+        :return: dict code: product (None when template not have products)
+        '''
+        pool = Pool()
+        ProductTemplate = pool.get('product.template')
+        ProductProduct = pool.get('product.product')
 
-                if 'url' in image: # magento = 1.3
-                    url = image.get('url')
-                else: # magento > 1.4
-                    url = image.get('filename')
-                if not url:
+        codes = list(set(c for c in codes if c))
+
+        index = {}
+        with Transaction().set_context(active_test=False):
+            for sub_codes in grouped_slice(codes):
+                for prod in ProductProduct.search([
+                        ('code', 'in', list(sub_codes)),
+                        ]):
+                    index.setdefault(prod.code, prod)
+
+        codes = [c for c in codes if c not in index]
+        for sub_codes in grouped_slice(codes):
+            for tpl in ProductTemplate.search([
+                    ('code', 'in', list(sub_codes)),
+                    ]):
+                if tpl.code in index:
                     continue
-                name = url.split('/')[-1:][0]
-                attachments = Attachment.search([
-                    ('name', 'ilike', name),
-                    ('resource', '=', '%s' % (template)),
-                    ], limit=1)
-                if attachments:
-                    action = 'update'
-                    attachment, = attachments
-                else:
-                    action = 'create'
-                    attachment = Attachment()
-
-                exclude = False
-                if image.get('exclude') == '1':
-                    exclude = True
-
-                base_image = False
-                small_image = False
-                thumbnail = False
-                if 'image' in image.get('types'):
-                    base_image = True
-                if 'small_image' in image.get('types'):
-                    small_image = True
-                if 'thumbnail' in image.get('types'):
-                    thumbnail = True
-
-                attachment.name = name
-                attachment.type = 'data'
-                attachment.data = urlopen(url).read()
-                attachment.resource = '%s' % (template)
-                attachment.description = image.get('label')
-                attachment.esale_available = True
-                attachment.esale_base_image = base_image
-                attachment.esale_small_image = small_image
-                attachment.esale_thumbnail = thumbnail
-                attachment.esale_exclude = exclude
-                attachment.esale_position = image.get('position')
-                attachment.save()
+                index[tpl.code] = tpl.products[0] if tpl.products else None
+        return index
 
-                logger.info(
-                    '%s image %s (%s)' % (action.capitalize(), name, attachment.id))
+    @staticmethod
+    def magento_fetch_product(product_api, product, store_views=[]):
+        '''
+        Fetch product info and product info by store views (run in threads:
+        not use Tryton records)
+        :param product_api: Magento Product API
+        :param product: dict (from product list)
+        :param store_views: list of tuples (store view code, language code)
+        :return: tuple (product, product info, list (language, info))
+        '''
+        product_info = product_api.info(product.get('product_id'))
+        langs_info = []
+        for store_view, language in store_views:
+            langs_info.append((language,
+                product_api.info(product.get('sku'), store_view=store_view)))
+        return product, product_info, langs_info
+
+    @classmethod
+    def magento_products_by_id(self, app):
+        '''
+        Walk Magento products by entity_id in windows of import_window
+        products, from the app ID range. The session is released before
+        every window is yield (the import uses the session pool)
+        :param app: object
+        :return: generator of tuples (products, values to save in the app)
+        '''
+        start, to_id = app.from_id_products, app.to_id_products
+        while start <= to_id:
+            end = min(start + IMPORT_WINDOW - 1, to_id)
+            ofilter = {
+                'entity_id': {
+                    'from': start,
+                    'to': end,
+                    },
+                }
+            with magento_api(app, Product) as product_api:
+                products = product_api.list(ofilter)
+            logger.info(
+                'Import Magento %s products: %s' % (len(products), ofilter))
+
+            # cursor: next import starts from the next window
+            data = {'from_id_products': end + 1}
+            if end == to_id:
+                data['to_id_products'] = None
+            yield products, data
+            start = end + 1
+
+    @classmethod
+    def magento_products_by_date(self, app):
+        '''
+        Get Magento products created or updated in the app date range
+        :param app: object
+        :return: generator of tuples (products, values to save in the app)
+        '''
+        ofilter = {
+            'created_at': {
+                'from': app.from_date_products,
+                'to': app.to_date_products,
+                },
+            }
+        ofilter2 = {
+            'updated_at': {
+                'from': app.from_date_products,
+                'to': app.to_date_products},
+            }
+        with magento_api(app, Product) as product_api:
+            products, duplicates = self.magento_merge_products(
+                product_api.list(ofilter), product_api.list(ofilter2))
+        logger.info(
+            'Import Magento %s products (%s duplicates): %s %s' % (
+                len(products), duplicates, ofilter, ofilter2))
+
+        data = {
+            'from_date_products': app.to_date_products,
+            'to_date_products': None,
+            }
+        yield products, data
+
+    @staticmethod
+    def magento_merge_products(*lists):
+        '''
+        Merge Magento product lists by product_id; keep the product with
+        newest updated_at
+        :param lists: lists of dict (from product list)
+        :return: tuple (list of dict, number of duplicates dropped)
+        '''
+        merged = {}
+        duplicates = 0
+        for products in lists:
+            for product in products:
+                product_id = product.get('product_id')
+                if product_id in merged:
+                    duplicates += 1
+                    if ((product.get('updated_at') or '') <=
+                            (merged[product_id].get('updated_at') or '')):
+                        continue
+                merged[product_id] = product
+        return list(merged.values()), duplicates
+
+    @classmethod
+    def import_magento_products(self, app, products):
+        '''
+        Import a window of Magento products (from product list)
+        :param app: object
+        :param products: list of dict
+        '''
+        # resolve all skus with one search by model
+        index = self.magento_products_by_code(
+            [product.get('sku') for product in products])
+
+        to_fetch = []
+        for product in products:
+            code = product.get('sku')
+            if not index.get(code) and code in index:
+                logger.warning(
+                    'Template code %s not have products' % (code))
+                continue
+            to_fetch.append(product)
+
+        # fetch product info (and by store view) in parallel
+        store_views = [(lang.storeview.code,
+                'en_US' if lang.default else lang.lang.code) #use default language to en_US
+            for lang in app.languages]
+        fetch = partial(self.magento_fetch_product,
+            store_views=store_views)
+
+        # save products by batch while next products are fetched
+        for fetched in chunks(magento_imap(app, Product, fetch, to_fetch),
+                IMPORT_BATCH):
+            templates = self.save_products(app,
+                [product_info for _, product_info, _ in fetched],
+                [index.get(product.get('sku')) for product, _, _ in fetched])
+
+            # save products by language: one write by language
+            languages = defaultdict(lambda: ([], []))
+            for (_, _, langs_info), template in zip(fetched, templates):
+                for language, product_info in langs_info:
+                    languages[language][0].append(template)
+                    languages[language][1].append(product_info)
+            for language, (tpls, datas) in languages.items():
+                self.save_products_language(app, tpls, datas, language)
+
+            # save images products
+            for (product, _, _), template in zip(fetched, templates):
+                self.save_product_images(app, template, product.get('product_id'))
 
     @classmethod
     @ModelView.button
@@ -617,10 +1001,6 @@ class MagentoApp(metaclass=PoolMeta):
         """Import Magento Products to Tryton
         Create/Update new products; not delete
         """
-        pool = Pool()
-        ProductTemplate = pool.get('product.template')
-        ProductProduct = pool.get('product.product')
-
         for app in apps:
             if not app.magento_websites:
                 raise UserError(gettext('magento_product.msg_import_magento_website'))
@@ -628,96 +1008,50 @@ class MagentoApp(metaclass=PoolMeta):
             logger.info(
                 'Start import products %s' % (app.name))
 
-            with Product(app.uri, app.username, app.password) as product_api:
-                ofilter = {}
-                data = {}
-                products = []
-
-                if app.from_date_products and app.to_date_products:
-                    ofilter = {
-                        'created_at': {
-                            'from': app.from_date_products,
-                            'to': app.to_date_products,
-                            },
-                        }
-                    ofilter2 = {
-                        'updated_at': {
-                            'from': app.from_date_products,
-                            'to': app.to_date_products},
-                        }
-                    products_created = product_api.list(ofilter)
-                    products_updated = products+product_api.list(ofilter2)
-                    products = products_created + products_updated
-                    ofilter = dict(ofilter.items() + ofilter2.items())
-                    data = {
-                        'from_date_products': app.to_date_products,
-                        'to_date_products': None,
-                        }
-
-                if app.from_id_products and app.to_id_products:
-                    ofilter = {
-                        'entity_id': {
-                            'from': app.from_id_products,
-                            'to': app.to_id_products,
-                            },
-                        }
-                    products = product_api.list(ofilter)
-                    data = {
-                        'from_id_products': app.to_id_products + 1,
-                        'to_id_products': None,
-                        }
-
-                if not products:
-                    raise UserError(gettext('magento_product.msg_not_import_products'))
+            windows = []
+            if app.from_id_products and app.to_id_products:
+                windows = self.magento_products_by_id(app)
+            elif app.from_date_products and app.to_date_products:
+                windows = self.magento_products_by_date(app)
 
-                logger.info(
-                    'Import Magento %s products: %s' % (len(products), ofilter))
+            total = 0
+            for products, data in windows:
+                if products:
+                    total += len(products)
+                    self.import_magento_products(app, products)
 
-                # Update last import
+                # Update last import (empty windows too): an interrupted
+                # import resumes from the last committed window
                 self.write([app], data)
+                Transaction().commit()
 
-                for product in products:
-                    product_id = product.get('product_id')
-                    code = product.get('sku')
-
-                    with Transaction().set_context(active_test=False):
-                        prods = ProductProduct.search([
-                            ('code', '=', product.get('sku')),
-                            ], limit=1)
-                    if prods:
-                        prod, = prods
-                    else:
-                        tpls = ProductTemplate.search([
-                            ('code', '=', product.get('sku')),
-                            ], limit=1)
-                        if tpls:
-                            tpl, = tpls
-                            if tpl.products:
-                                prod = tpl.products[0]
-                            else:
-                                logger.warning(
-                                    'Template ID %s not have products' % (
-                                        tpl.id))
-                                continue
-                        else:
-                            prod = None
-
-                    #save product data
-                    product_info = product_api.info(product_id)
-                    template = self.save_product(app, product_info, prod)
-
-                    # save products by language
-                    for lang in app.languages:
-                        product_info = product_api.info(code, store_view=lang.storeview.code)
-                        language = 'en_US' if lang.default else lang.lang.code #use default language to en_US
-                        self.save_product_language(app, template, product_info, language)
+            if not total:
+                raise UserError(gettext('magento_product.msg_not_import_products'))
 
-                    # save images products
-                    self.save_product_images(app, template, product_id)
+            logger.info('End import products %s' % (app.name))
 
-                    Transaction().commit()
+    @classmethod
+    def reconcile_product_map(self, apps=None):
+        """Reconcile the local SKU - Magento product ID map with the
+        products available in Magento (cron)
+        """
+        ProductMap = Pool().get('magento.product.map')
 
-            logger.info('End import products %s' % (app.name))
+        if apps is None:
+            apps = self.search([])
+        for app in apps:
+            try:
+                with magento_api(app, Product) as product_api:
+                    remotes = dict((p['sku'], p['product_id'])
+                        for p in product_api.list() if p.get('sku'))
+            except Exception as e:
+                logger.error('Reconcile product map %s: %s' % (app.name, e))
+                continue
+            deleted, updated, created = ProductMap.reconcile(app, remotes)
+            Transaction().commit()
+            logger.info(
+                'Reconcile product map %s: %s created, %s updated, '
+                '%s deleted' % (app.name, created, updated, deleted))
 
     @classmethod
     @ModelView.button
@@ -734,9 +1068,196 @@ class MagentoApp(metaclass=PoolMeta):
             logger.info('End import product links %s' % (app.name))
 
 
+class MagentoExternalReferential(metaclass=PoolMeta):
+    __name__ = 'magento.external.referential'
+
+    @classmethod
+    @contextmanager
+    def referential_cache(cls):
+        '''
+        Cache get_try2mgn lookups (app, model, Tryton ID) while the context
+        is open (an export run). Nested contexts share the cache.
+        '''
+        if getattr(_REFERENTIAL_CACHE, 'values', None) is not None:
+            yield
+            return
+        _REFERENTIAL_CACHE.values = {}
+        try:
+            yield
+        finally:
+            _REFERENTIAL_CACHE.values = None
+
+    @classmethod
+    def get_try2mgn(cls, app, model, try_id):
+        cache = getattr(_REFERENTIAL_CACHE, 'values', None)
+        if cache is None:
+            return super(MagentoExternalReferential, cls).get_try2mgn(app,
+                model, try_id)
+        key = (app.id, model, try_id)
+        if key not in cache:
+            cache[key] = super(MagentoExternalReferential, cls).get_try2mgn(
+                app, model, try_id)
+        return cache[key]
+
+    @classmethod
+    def get_mgn2try_ids(cls, app, model, mgn_ids):
+        '''
+        Map Magento IDs to Tryton IDs in bulk
+        :param app: object
+        :param model: str
+        :param mgn_ids: list
+        :return: dict Magento ID (str): Tryton ID
+        '''
+        result = {}
+        for sub_ids in grouped_slice(list(set(mgn_ids))):
+            for ref in cls.search([
+                    ('app', '=', app.id),
+                    ('model.model', '=', model),
+                    ('mgn_id', 'in', list(sub_ids)),
+                    ]):
+                result[str(ref.mgn_id)] = ref.try_id
+        return result
+
+    @classmethod
+    def get_try2mgn_ids(cls, app, model, try_ids):
+        '''
+        Map Tryton IDs to Magento IDs in bulk
+        :param app: object
+        :param model: str
+        :param try_ids: list
+        :return: dict Tryton ID: Magento ID
+        '''
+        result = {}
+        for sub_ids in grouped_slice(list(set(try_ids))):
+            for ref in cls.search([
+                    ('app', '=', app.id),
+                    ('model.model', '=', model),
+                    ('try_id', 'in', list(sub_ids)),
+                    ]):
+                result[ref.try_id] = ref.mgn_id
+        return result
+
+
 class MagentoSaleShopGroupPrice(ModelSQL, ModelView):
     'Magento Sale Shop Group Price'
     __name__ = 'magento.sale.shop.group.price'
     shop = fields.Many2One('sale.shop', 'Shop', required=True)
     group = fields.Many2One('magento.customer.group', 'Customer Group', required=True)
     price_list = fields.Many2One('product.price_list', 'Pricelist', required=True)
+
+
+class MagentoFingerprint(ModelSQL):
+    'Magento Fingerprint'
+    __name__ = 'magento.fingerprint'
+    app = fields.Many2One('magento.app', 'APP', required=True,
+        ondelete='CASCADE', select=True)
+    resource = fields.Char('Resource', required=True, select=True,
+        help='Tryton record (model,id)')
+    scope = fields.Char('Scope', required=True,
+        help='Language, store view or website (price) of the values')
+    fingerprint = fields.Char('Fingerprint', required=True)
+    values = fields.Text('Values', help='Digest of every key of the values '
+        '(JSON)')
+
+    @classmethod
+    def __setup__(cls):
+        super(MagentoFingerprint, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('resource_scope_uniq', Unique(t, t.app, t.resource, t.scope),
+                'Fingerprint must be unique by resource and scope.'),
+        ]
+
+    @classmethod
+    def get_fingerprints(cls, app, resources):
+        '''
+        Get fingerprints of resources
+        :param app: object
+        :param resources: list of str (model,id)
+        :return: dict (resource, scope): fingerprint
+        '''
+        fingerprints = {}
+        for sub_resources in grouped_slice(resources):
+            for record in cls.search([
+                    ('app', '=', app.id),
+                    ('resource', 'in', list(sub_resources)),
+                    ]):
+                fingerprints[(record.resource, record.scope)] = \
+                    record.fingerprint
+        return fingerprints
+
+    @classmethod
+    def set_fingerprints(cls, app, fingerprints, values=None):
+        '''
+        Save fingerprints of resources
+        :param app: object
+        :param fingerprints: dict (resource, scope): fingerprint
+        :param values: dict (resource, scope): values text (optional)
+        '''
+        if not fingerprints:
+            return
+        fingerprints = fingerprints.copy()
+        values = values or {}
+
+        def vals(key, fingerprint):
+            vals = {'fingerprint': fingerprint}
+            if key in values:
+                vals['values'] = values[key]
+            return vals
+
+        to_write = []
+        keys = list(fingerprints.keys())
+        for sub_keys in grouped_slice(keys):
+            sub_keys = list(sub_keys)
+            for record in cls.search([
+                    ('app', '=', app.id),
+                    ('resource', 'in', [r for r, _ in sub_keys]),
+                    ]):
+                key = (record.resource, record.scope)
+                if key in fingerprints:
+                    value = fingerprints.pop(key)
+                    if record.fingerprint != value:
+                        to_write.extend(([record], vals(key, value)))
+        if to_write:
+            cls.write(*to_write)
+        if fingerprints:
+            to_create = []
+            for (resource, scope), value in fingerprints.items():
+                data = vals((resource, scope), value)
+                data.update({
+                        'app': app.id,
+                        'resource': resource,
+                        'scope': scope,
+                        })
+                to_create.append(data)
+            cls.create(to_create)
+
+    @classmethod
+    def get_digests(cls, app, resources):
+        '''
+        Get the digests by key of the last values of resources
+        :param app: object
+        :param resources: list of str (model,id)
+        :return: dict (resource, scope): dict key: digest
+        '''
+        digests = {}
+        for sub_resources in grouped_slice(resources):
+            for record in cls.search([
+                    ('app', '=', app.id),
+                    ('resource', 'in', list(sub_resources)),
+                    ]):
+                digests[(record.resource, record.scope)] = json.loads(
+                    record.values or '{}')
+        return digests
+
+    @classmethod
+    def set_digests(cls, app, digests):
+        '''
+        Save the digests by key of the last values of resources
+        :param app: object
+        :param digests: dict (resource, scope): dict key: digest
+        '''
+        cls.set_fingerprints(app,
+            dict((k, fingerprint(v)) for k, v in digests.items()),
+            dict((k, json.dumps(v, sort_keys=True))
+                for k, v in digests.items()))
@@ -0,0 +1,79 @@
+# This file is part magento_product module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['PriceListLine']
+
+
+class PriceListLine(metaclass=PoolMeta):
+    __name__ = 'product.price_list.line'
+
+    @classmethod
+    def create(cls, vlist):
+        lines = super(PriceListLine, cls).create(vlist)
+        cls.magento_enqueue(cls.magento_outbox_keys(lines))
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        # the old price list and product of the lines where they change
+        old_keys = set()
+        actions = iter(args)
+        for lines, values in zip(actions, actions):
+            if 'price_list' in values or 'product' in values:
+                old_keys |= cls.magento_outbox_keys(lines)
+        super(PriceListLine, cls).write(*args)
+        cls.magento_enqueue(old_keys
+            | cls.magento_outbox_keys(sum(args[0:None:2], [])))
+
+    @classmethod
+    def delete(cls, lines):
+        keys = cls.magento_outbox_keys(lines)
+        super(PriceListLine, cls).delete(lines)
+        cls.magento_enqueue(keys)
+
+    @staticmethod
+    def magento_outbox_keys(lines):
+        '''Price list and product (None: all products) of the lines'''
+        return set((l.price_list.id, getattr(l, 'product', None) and
+                l.product.id) for l in lines)
+
+    @classmethod
+    def magento_enqueue(cls, keys):
+        '''Add the products of the lines to the Magento outbox (prices) of
+        the shops that use the price lists
+        :param keys: set of tuples (price list ID, product ID or None)
+        '''
+        pool = Pool()
+        Shop = pool.get('sale.shop')
+        Product = pool.get('product.product')
+        Outbox = pool.get('magento.product.outbox')
+
+        price_lists = set(price_list for price_list, _ in keys)
+        if not price_lists:
+            return
+        shops = Shop.search([
+                ('esale_shop_app', '=', 'magento'),
+                ['OR',
+                    ('price_list', 'in', list(price_lists)),
+                    ('magento_shop_group_prices.price_list', 'in',
+                        list(price_lists)),
+                    ],
+                ])
+        for shop in shops:
+            shop_lists = set(g.price_list.id
+                for g in shop.magento_shop_group_prices)
+            if shop.price_list:
+                shop_lists.add(shop.price_list.id)
+            product_ids = set(product for price_list, product in keys
+                if price_list in shop_lists)
+            if not product_ids:
+                continue
+            if None in product_ids:
+                # lines of all products
+                products = Product.search(
+                    Product.magento_product_domain([shop.id]))
+            else:
+                products = Product.browse(list(product_ids))
+            Outbox.enqueue(products, ['price'], shops=[shop])
@@ -5,20 +5,22 @@ from datetime import datetime
 from decimal import Decimal
 from creole import creole2html
 from io import BytesIO
-from trytond.model import ModelView, ModelSQL, fields
+from trytond.model import ModelView, ModelSQL, fields, Unique
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, Not, Equal, Or
 from trytond.transaction import Transaction
 from trytond import backend
-from trytond.tools import grouped_slice
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.config import config as config_
 from trytond.modules.product_esale.tools import esale_eval, slugify, unaccent
 import unicodecsv
 
 __all__ = ['MagentoProductType', 'MagentoAttributeConfigurable',
-    'TemplateMagentoAttributeConfigurable', 'Template', 'Product']
+    'TemplateMagentoAttributeConfigurable', 'MagentoProductMap',
+    'MagentoProductOutbox', 'Template', 'Product']
 
 MAX_CSV = config_.getint('magento', 'max_csv', default=50)
+_OUTBOX_KINDS = ['product', 'price', 'image']
 _MAGENTO_VISIBILITY = {
     'none': '1',
     'catalog': '2',
@@ -83,6 +85,197 @@ class TemplateMagentoAttributeConfigurable(ModelSQL):
         super(TemplateMagentoAttributeConfigurable, cls).__register__(module_name)
 
 
+class MagentoProductMap(ModelSQL):
+    'Magento Product Map'
+    __name__ = 'magento.product.map'
+    app = fields.Many2One('magento.app', 'APP', required=True,
+        ondelete='CASCADE', select=True)
+    sku = fields.Char('SKU', required=True, select=True)
+    mgn_id = fields.Integer('Mgn ID', required=True,
+        help='Magento Product ID')
+
+    @classmethod
+    def __setup__(cls):
+        super(MagentoProductMap, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('app_sku_uniq', Unique(t, t.app, t.sku),
+                'SKU must be unique by Magento APP.'),
+        ]
+
+    @classmethod
+    def get_map(cls, app, codes):
+        '''
+        Magento product IDs of SKUs
+        :param app: object
+        :param codes: list
+        :return: dict sku: Magento product ID
+        '''
+        result = {}
+        for sub_codes in grouped_slice(list(set(codes))):
+            for record in cls.search([
+                    ('app', '=', app.id),
+                    ('sku', 'in', list(sub_codes)),
+                    ]):
+                result[record.sku] = record.mgn_id
+        return result
+
+    @classmethod
+    def set_map(cls, app, values):
+        '''
+        Save Magento product IDs of SKUs
+        :param app: object
+        :param values: dict sku: Magento product ID
+        '''
+        if not values:
+            return
+        values = dict((sku, int(mgn_id)) for sku, mgn_id in values.items())
+        to_write = []
+        for sub_codes in grouped_slice(list(values.keys())):
+            for record in cls.search([
+                    ('app', '=', app.id),
+                    ('sku', 'in', list(sub_codes)),
+                    ]):
+                mgn_id = values.pop(record.sku)
+                if record.mgn_id != mgn_id:
+                    to_write.extend(([record], {'mgn_id': mgn_id}))
+        if to_write:
+            cls.write(*to_write)
+        if values:
+            cls.create([{
+                        'app': app.id,
+                        'sku': sku,
+                        'mgn_id': mgn_id,
+                        } for sku, mgn_id in values.items()])
+
+    @classmethod
+    def remove_map(cls, app, codes):
+        '''
+        Remove SKUs from the map (products not found in Magento)
+        :param app: object
+        :param codes: list
+        '''
+        for sub_codes in grouped_slice(list(set(codes))):
+            records = cls.search([
+                    ('app', '=', app.id),
+                    ('sku', 'in', list(sub_codes)),
+                    ])
+            if records:
+                cls.delete(records)
+
+    @classmethod
+    def reconcile(cls, app, remotes):
+        '''
+        Fix the map of an app with the products available in Magento
+        :param app: object
+        :param remotes: dict sku: Magento product ID (all Magento products)
+        :return: tuple (deleted, updated, created)
+        '''
+        remotes = dict((sku, int(mgn_id)) for sku, mgn_id in remotes.items())
+        to_delete = []
+        to_write = []
+        for record in cls.search([('app', '=', app.id)]):
+            mgn_id = remotes.pop(record.sku, None)
+            if mgn_id is None:
+                to_delete.append(record)
+            elif record.mgn_id != mgn_id:
+                to_write.extend(([record], {'mgn_id': mgn_id}))
+        if to_delete:
+            cls.delete(to_delete)
+        if to_write:
+            cls.write(*to_write)
+        if remotes:
+            cls.create([{
+                        'app': app.id,
+                        'sku': sku,
+                        'mgn_id': mgn_id,
+                        } for sku, mgn_id in remotes.items()])
+        return len(to_delete), len(to_write) // 2, len(remotes)
+
+
+class MagentoProductOutbox(ModelSQL):
+    'Magento Product Outbox'
+    __name__ = 'magento.product.outbox'
+    shop = fields.Many2One('sale.shop', 'Shop', required=True,
+        ondelete='CASCADE', select=True)
+    product = fields.Many2One('product.product', 'Product', required=True,
+        ondelete='CASCADE')
+    kind = fields.Selection([
+            ('product', 'Product'),
+            ('price', 'Price'),
+            ('image', 'Image'),
+            ], 'Kind', required=True, select=True)
+
+    @classmethod
+    def enqueue(cls, products, kinds=None, shops=None):
+        '''
+        Add products to export to the Magento shops of the products (not
+        when the context has magento_outbox False: changes from exports)
+        :param products: list
+        :param kinds: list (default all kinds)
+        :param shops: list (default the shops of the products)
+        '''
+        if not Transaction().context.get('magento_outbox', True):
+            return
+        kinds = kinds or _OUTBOX_KINDS
+        to_create = set()
+        for product in products:
+            for shop in (shops if shops is not None
+                    else product.template.shops):
+                if shop.esale_shop_app != 'magento':
+                    continue
+                for kind in kinds:
+                    to_create.add((shop.id, product.id, kind))
+        if to_create:
+            cls.create([{
+                        'shop': shop,
+                        'product': product,
+                        'kind': kind,
+                        } for shop, product, kind in sorted(to_create)])
+
+    @classmethod
+    def pending(cls, shop, kind):
+        '''
+        Products to export of a shop, in the outbox order
+        :param shop: object
+        :param kind: str
+        :return: tuple (list of product IDs, list of outbox IDs)
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.select(table.id, table.product,
+                where=(table.shop == shop.id) & (table.kind == kind),
+                order_by=table.id.asc))
+        product_ids = []
+        outbox_ids = []
+        seen = set()
+        for id_, product_id in cursor.fetchall():
+            outbox_ids.append(id_)
+            if product_id not in seen:
+                seen.add(product_id)
+                product_ids.append(product_id)
+        return product_ids, outbox_ids
+
+    @classmethod
+    def drain(cls, shop, kind, ids):
+        '''
+        Remove the exported rows of the outbox. Only the rows read by
+        pending are removed: rows enqueued meanwhile (maybe with a lower
+        ID, as sequence order is not commit order) wait the next export
+        :param shop: object
+        :param kind: str
+        :param ids: list of outbox IDs
+        '''
+        if not ids:
+            return
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.delete(
+                    where=(table.shop == shop.id) & (table.kind == kind)
+                    & reduce_ids(table.id, sub_ids)))
+
+
 class Template(metaclass=PoolMeta):
     __name__ = 'product.template'
     magento_product_type = fields.Selection('get_magento_product_type', 'Product Type',
@@ -131,6 +324,65 @@ class Template(metaclass=PoolMeta):
             types.append((type_.code, type_.name))
         return types
 
+    @classmethod
+    def esale_product_values(cls, shop, vals):
+        '''
+        Values of a new eSale product with the defaults of the shop (used
+        by create_esale_product and create_esale_products)
+        :param shop: object
+        :param vals: dict
+        :return: dict
+        '''
+        vals = vals.copy()
+        uom = shop.esale_uom_product
+        if uom:
+            vals.setdefault('default_uom', uom.id)
+            if 'sale_uom' in cls._fields:
+                vals.setdefault('sale_uom', uom.id)
+        if 'account_category' in cls._fields and getattr(
+                shop, 'esale_account_category', None):
+            vals.setdefault('account_category',
+                shop.esale_account_category.id)
+        return vals
+
+    @classmethod
+    def create_esale_product(cls, shop, vals):
+        return super(Template, cls).create_esale_product(shop,
+            cls.esale_product_values(shop, vals))
+
+    @classmethod
+    def create_esale_products(cls, shop, vlist):
+        '''
+        Create eSale products with one create call. When a module
+        overrides create_esale_product after this module, products are
+        created one by one to keep the override
+        :param shop: object
+        :param vlist: list of dict
+        :return: list of templates
+        '''
+        if (cls.create_esale_product.__func__
+                is not Template.__dict__['create_esale_product'].__func__):
+            return [cls.create_esale_product(shop, vals) for vals in vlist]
+        return cls.create([cls.esale_product_values(shop, vals)
+                for vals in vlist])
+
+    @classmethod
+    def create(cls, vlist):
+        templates = super(Template, cls).create(vlist)
+        cls.magento_enqueue(templates)
+        return templates
+
+    @classmethod
+    def write(cls, *args):
+        super(Template, cls).write(*args)
+        cls.magento_enqueue(sum(args[0:None:2], []))
+
+    @classmethod
+    def magento_enqueue(cls, templates, kinds=None):
+        '''Add the products of templates to the Magento outbox'''
+        Outbox = Pool().get('magento.product.outbox')
+        Outbox.enqueue([p for t in templates for p in t.products], kinds)
+
     @staticmethod
     def default_magento_product_type():
         product_type = None
@@ -147,6 +399,19 @@ class Template(metaclass=PoolMeta):
 class Product(metaclass=PoolMeta):
     __name__ = 'product.product'
 
+    @classmethod
+    def create(cls, vlist):
+        Outbox = Pool().get('magento.product.outbox')
+        products = super(Product, cls).create(vlist)
+        Outbox.enqueue(products)
+        return products
+
+    @classmethod
+    def write(cls, *args):
+        Outbox = Pool().get('magento.product.outbox')
+        super(Product, cls).write(*args)
+        Outbox.enqueue(sum(args[0:None:2], []))
+
     @classmethod
     def get_magento_product_type(cls):
         Template = Pool().get('product.template')
@@ -196,8 +461,9 @@ class Product(metaclass=PoolMeta):
         return vals
 
     @classmethod
-    def magento_export_product(cls, app, product, shop=None, lang='en_US'):
-        '''Magento Export Product values'''
+    def magento_export_product(cls, app, product, shop=None, lang='en_US',
+            prices=None):
+        '''Magento Export Product values (prices: computed shop prices)'''
         pool = Pool()
         MagentoExternalReferential = pool.get('magento.external.referential')
         Product = pool.get('product.product')
@@ -223,7 +489,8 @@ class Product(metaclass=PoolMeta):
         vals['url_key'] = product.esale_slug if product.esale_slug else product.template.esale_slug
         vals['cost'] = str(product.cost_price)
         if shop:
-            prices = shop.magento_get_prices(product)
+            if prices is None:
+                prices = shop.magento_get_prices(product)
             vals.update(prices)
         else:
             vals['price'] = str(product.list_price)
@@ -300,7 +567,9 @@ class Product(metaclass=PoolMeta):
 
     @classmethod
     def esale_export_csv_magento(cls, shop, products, lang):
-        Product = Pool().get('product.product')
+        pool = Pool()
+        Product = pool.get('product.product')
+        MagentoExternalReferential = pool.get('magento.external.referential')
 
         values, keys = [], set()
         if products:
@@ -311,14 +580,15 @@ class Product(metaclass=PoolMeta):
             with Transaction().set_context(context):
                 quantities = shop.get_esale_product_quantity(products)
 
-            for sub_products in grouped_slice(products, MAX_CSV):
-                for product in sub_products:
-                    quantity = quantities[product.id]
-                    vals = Product.magento_export_product_csv(
-                        app, product, shop, lang, quantity)
-                    for k in vals.keys():
-                        keys.add(k)
-                    values.append(vals)
+            with MagentoExternalReferential.referential_cache():
+                for sub_products in grouped_slice(products, MAX_CSV):
+                    for product in sub_products:
+                        quantity = quantities[product.id]
+                        vals = Product.magento_export_product_csv(
+                            app, product, shop, lang, quantity)
+                        for k in vals.keys():
+                            keys.add(k)
+                        values.append(vals)
 
         output = BytesIO()
         wr = unicodecsv.DictWriter(output, sorted(list(keys)),
@@ -9,15 +9,28 @@ from trytond.tools import grouped_slice
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
 from trytond.config import config as config_
+from trytond.filestore import filestore
 from mimetypes import guess_type
 from magento import *
-import datetime
+from .tools import (changed_values, chunks, fault_code, fingerprint,
+    image_transform, magento_api, magento_imap, magento_multicall,
+    magento_shared_api, ByteSemaphore, Image, MAX_CONNECTIONS,
+    PRODUCT_NOT_EXISTS)
 import logging
 import base64
 
 __all__ = ['SaleShop']
 
-MAX_CONNECTIONS = config_.getint('magento', 'max_connections', default=50)
+EXPORT_CHUNK = config_.getint('magento', 'export_chunk', default=500)
+# max bytes of the images loaded (and encoded) by all the workers
+IMAGE_MEMORY = config_.getint('magento', 'image_memory',
+    default=256 * 1024 * 1024)
+# images greater than it are not exported (0: all images are exported; not
+# applied to the source images when the shop transforms the images)
+IMAGE_SKIP_SIZE = config_.getint('magento', 'image_skip_size', default=0)
+# copies of an image in memory while it is sent: data, base64 content and
+# XML-RPC request
+_IMAGE_COPIES = 4
 _MIME_TYPES = ['image/jpeg', 'image/png']
 logger = logging.getLogger(__name__)
 
@@ -28,6 +41,23 @@ class SaleShop(metaclass=PoolMeta):
         help='If check this value, when export product prices add prices by group')
     magento_shop_group_prices = fields.One2Many('magento.sale.shop.group.price', 'shop',
         'Magento Shop Grup Price')
+    magento_image_transform = fields.Boolean('Magento Transform Images',
+        help='Resize and compress images before export them to Magento '
+        '(require Pillow)')
+    magento_image_max_dimension = fields.Integer('Image Max Dimension',
+        states={
+            'invisible': Not(Eval('magento_image_transform', False)),
+            }, depends=['magento_image_transform'],
+        help='Max width or height of the images (pixels)')
+    magento_image_quality = fields.Integer('Image Quality',
+        states={
+            'invisible': Not(Eval('magento_image_transform', False)),
+            }, depends=['magento_image_transform'],
+        help='JPEG quality of the images (1-95)')
+
+    @staticmethod
+    def default_magento_image_quality():
+        return 85
 
     @classmethod
     def view_attributes(cls):
@@ -44,317 +74,551 @@ class SaleShop(metaclass=PoolMeta):
         :param quantity: int
         :return dicc
         """
+        return self.magento_get_products_prices([product], quantity)[
+            product.id]
+
+    def magento_prices_w_taxes(self, products, prices, quantity=1):
+        """
+        Prices with taxes: products with the same customer taxes and price
+        are computed once
+        :param products: list
+        :param prices: dict product ID: price
+        :param quantity: int
+        :return: dict product ID: price with taxes
+        """
+        cache = {}
+        res = {}
+        for product in products:
+            price = prices[product.id]
+            key = (tuple(sorted(t.id for t in
+                        product.template.customer_taxes_used)), price)
+            if key not in cache:
+                cache[key] = self.esale_price_w_taxes(product, price,
+                    quantity)
+            res[product.id] = cache[key]
+        return res
+
+    def magento_get_products_prices(self, products, quantity=1):
+        """
+        Get Products Price, Sepcial Price and Group price
+        from price list or price (with or not taxes).
+        Compute prices of all products with one call by price list.
+        :param products: list
+        :param quantity: int
+        :return: dict product ID: dicc
+        """
         pool = Pool()
         Product = pool.get('product.product')
 
-        # Sale Price
-        price = 0
-        if self.esale_price == 'pricelist' and self.price_list and self.esale_price_party:
+        if not products:
+            return {}
+
+        def sale_prices(products, price_list, without_special_price=False):
             context = {
-                'price_list': self.price_list.id,
+                'price_list': price_list.id,
                 'customer': self.esale_price_party.id,
-                'without_special_price': True,
                 }
+            if without_special_price:
+                context['without_special_price'] = True
             with Transaction().set_context(context):
-                prices = Product.get_sale_price([product], quantity)
-                price = prices[product.id]
+                return Product.get_sale_price(products, quantity)
+
+        # Sale Price
+        if self.esale_price == 'pricelist' and self.price_list and self.esale_price_party:
+            prices = sale_prices(products, self.price_list, True)
         else:
-            price = product.template.list_price
+            prices = dict((p.id, p.template.list_price) for p in products)
 
         if self.esale_tax_include:
-            price = self.esale_price_w_taxes(product, price, quantity)
+            prices = self.magento_prices_w_taxes(products, prices, quantity)
 
         # Special Price
-        special_price = ''
+        special_prices = {}
         shop_special_price = False
         if hasattr(self, 'special_price'):
             shop_special_price = True
         if shop_special_price and self.special_price:
             if self.type_special_price == 'pricelist':
-                context = {
-                    'price_list': self.price_list.id,
-                    'customer': self.esale_price_party.id,
-                    }
-                with Transaction().set_context(context):
-                    special_prices = Product.get_sale_price([product],
-                        quantity)
-                    special_price = special_prices[product.id]
+                special_prices = sale_prices(products, self.price_list)
             else:
-                special_price = product.template.special_price or 0
+                special_prices = dict((p.id, p.template.special_price or 0)
+                    for p in products)
 
             if self.esale_tax_include:
-                special_price = self.esale_price_w_taxes(product, special_price, quantity)
-
-            if not (special_price > 0.0 and special_price < price):
-                special_price = ''
+                special_prices = self.magento_prices_w_taxes(products,
+                    special_prices, quantity)
 
         # Group Price
-        group_price = []
-        if self.magento_shop_group_prices and product.magento_group_price:
+        group_prices = {}
+        group_products = [p for p in products if p.magento_group_price]
+        if self.magento_shop_group_prices and group_products:
             # {'cust_group': '0', 'website_price': '10.0000', 'price': '10.0000',
             # 'website_id': '0', 'price_id': '1', 'all_groups': '0'}
-            for group_prices in self.magento_shop_group_prices:
-                context = {
-                    'price_list': group_prices.price_list.id,
-                    'customer': self.esale_price_party.id,
-                    'without_special_price': True,
-                    }
-                with Transaction().set_context(context):
-                    gprices = Product.get_sale_price([product],
-                        quantity)
-                    gprice = gprices[product.id]
-                if gprice > 0.0:
+            price_list_prices = {}
+            for shop_group_price in self.magento_shop_group_prices:
+                price_list = shop_group_price.price_list
+                if price_list.id not in price_list_prices:
+                    gprices = sale_prices(group_products, price_list, True)
                     if self.esale_tax_include:
-                        gprice = self.esale_price_w_taxes(product, gprice, quantity)
-                    group_price.append({
-                        'cust_group': group_prices.group.customer_group,
+                        gprices = self.magento_prices_w_taxes(
+                            [p for p in group_products
+                                if gprices[p.id] > 0.0],
+                            gprices, quantity)
+                    price_list_prices[price_list.id] = gprices
+                gprices = price_list_prices[price_list.id]
+                for product in group_products:
+                    gprice = gprices.get(product.id)
+                    if gprice is None or not gprice > 0.0:
+                        continue
+                    group_prices.setdefault(product.id, []).append({
+                        'cust_group': shop_group_price.group.customer_group,
                         'price': str(gprice),
                         })
 
-        data = {}
-        data['price'] = str(price)
-        if shop_special_price:
-            data['special_price'] = str(special_price)
+        res = {}
+        for product in products:
+            price = prices[product.id]
+            data = {}
+            data['price'] = str(price)
             if shop_special_price:
+                special_price = special_prices.get(product.id, '')
+                if not (special_price != '' and special_price > 0.0
+                        and special_price < price):
+                    special_price = ''
+                data['special_price'] = str(special_price)
                 data['special_from_date'] = product.special_price_from.strftime("%Y-%m-%d %H:%M:%S") if product.special_price_from else ''
                 data['special_to_date'] = product.special_price_to.strftime("%Y-%m-%d %H:%M:%S") if product.special_price_to else ''
-        data['group_price'] = group_price
-        return data
+            data['group_price'] = group_prices.get(product.id, [])
+            res[product.id] = data
+        return res
 
-    def export_products_magento(self, tpls=[]):
-        """Export Products to Magento
-        :param tpls: list
+    @staticmethod
+    def magento_products_by_sku(product_api, codes):
+        """Magento products by SKU with one list call
+        :param product_api: Magento Product API
+        :param codes: list
+        :return: dict sku: Magento product ID
+        """
+        if not codes:
+            return {}
+        return dict((p['sku'], p['product_id'])
+            for p in product_api.list({'sku': {'in': codes}}))
+
+    def magento_export_jobs(self, app, templates, mgn_skus, digests,
+            language):
+        """Export jobs of templates: every job is the ordered list of
+        Magento calls of a template (products, configurable and languages)
+        :param app: object
+        :param templates: list
+        :param mgn_skus: dict sku: Magento product ID (products in Magento)
+        :param digests: dict (resource, scope): digests of last values
+        :param language: str (default language)
+        :return: generator of dict
         """
         pool = Pool()
         Prod = pool.get('product.product')
         MagentoExternalReferential = pool.get('magento.external.referential')
-        BaseExternalMapping = pool.get('base.external.mapping')
-
-        product_domain = Prod.magento_product_domain([self.id])
-
-        context = Transaction().context
 
-        if tpls:
-            product_domain += [('template.id', 'in', tpls)]
-        else:
-            now = datetime.datetime.now()
-            last_products = self.esale_last_products
+        products_prices = self.magento_get_products_prices(
+            [p for t in templates for p in t.products if p.code])
 
-            product_domain += [['OR',
-                        ('create_date', '>=', last_products),
-                        ('write_date', '>=', last_products),
-                        ('template.create_date', '>=', last_products),
-                        ('template.write_date', '>=', last_products),
-                    ]]
+        for template in templates:
+            product_type = template.magento_product_type
 
-            # Update date last import
-            self.write([self], {'esale_last_products': now})
-            Transaction().commit()
+            if not template.esale_attribute_group:
+                message = 'Magento %s. Error export template ID %s. ' \
+                        'Select eSale Attribute' % (self.name, template.id)
+                logger.error(message)
+                continue
 
-        products = Prod.search(product_domain)
-        templates = list(set(p.template for p in products))
+            job = {
+                'shop': self.name,
+                'identifier_type': app.identifier_type,
+                'multicall_size': app.multicall_size,
+                'steps': [],
+                }
+            steps = job['steps']
+            attribute_mgn = None
 
-        if not templates:
-            logger.info(
-                'Magento %s. Not products to export.' % (self.name))
-            return
+            total_products = len(template.products)
 
-        logger.info(
-            'Magento %s. Start export %s product(s).' % (
-                self.name, len(templates)))
+            for product in template.products:
+                if not product.code:
+                    message = 'Magento %s. Error export product ID %s. ' \
+                            'Add a code' % (self.name, product.id)
+                    logger.error(message)
+                    continue
 
-        app = self.magento_website.magento_app
-        language = app.default_lang.code or context.get('language')
+                code = product.code
+                values = Prod.magento_export_product(app, product, shop=self,
+                    lang=language, prices=products_prices[product.id])
+
+                if not values.get('tax_class_id'):
+                    for tax in app.magento_taxes:
+                        values['tax_class_id'] = tax.tax_id
+                        break
+                if product_type == 'configurable':
+                    # force visibility Not Visible Individually
+                    values['visibility'] = '1'
+                    # product name from product_name module if installed
+                    values['name'] = product.name if product.name else product.template.name
+                    # each variant add attribute options in product name
+                if product_type == 'grouped':
+                    # force visibility Not Visible Individually
+                    values['visibility'] = '1'
+
+                # if products > 1, add code prefix in url key
+                if total_products > 1:
+                    url_key = values.get('url_key')
+                    values['url_key'] = '%s-%s' % (code.lower(), url_key)
+
+                if app.debug:
+                    message = 'Magento %s. Product: %s. Values: %s' % (
+                            self.name, code, values)
+                    logger.info(message)
 
-        for sub_templates in grouped_slice(templates, MAX_CONNECTIONS):
-            with Product(app.uri, app.username, app.password) as product_api:
-                for template in sub_templates:
-                    product_type = template.magento_product_type
+                key = (str(product), 'default')
+                if code in mgn_skus:
+                    values, digest = changed_values(
+                        values, digests.get(key, {}))
+                    if values:
+                        steps.append({'sku': code, 'method': 'update',
+                                'args': (values, None), 'key': key,
+                                'digest': digest})
+                    else:
+                        logger.info('Magento %s. Product %s not changed' % (
+                                self.name, code))
+                else:
+                    _, digest = changed_values(values, {})
+                    del values['sku']
 
-                    if not template.esale_attribute_group:
-                        message = 'Magento %s. Error export template ID %s. ' \
-                                'Select eSale Attribute' % (self.name, template.id)
-                        logger.error(message)
+                    # Product type
+                    if product_type == 'configurable':
+                        magento_product_type = 'simple'
+                    else:
+                        magento_product_type = product.template.magento_product_type
+
+                    if attribute_mgn is None:
+                        ext_ref = MagentoExternalReferential.get_try2mgn(app,
+                                'esale.attribute.group',
+                                template.esale_attribute_group.id)
+                        attribute_mgn = ext_ref.mgn_id
+                    steps.append({'sku': code, 'method': 'create',
+                            'args': (magento_product_type, attribute_mgn,
+                                values),
+                            'key': key, 'digest': digest})
+
+                # save products by language
+                for l in app.languages:
+                    if language == l.lang.code:
                         continue
+                    values = Prod.magento_export_product(app, product, lang=l.lang.code)
 
-                    total_products = len(template.products)
-
-                    for product in template.products:
-                        if not product.code:
-                            message = 'Magento %s. Error export product ID %s. ' \
-                                    'Add a code' % (self.name, product.id)
-                            logger.error(message)
-                            continue
-
-                        code = product.code
-                        values = Prod.magento_export_product(app, product, shop=self, lang=language)
-                        prices = self.magento_get_prices(product)
-                        values.update(prices)
-
-                        if not values.get('tax_class_id'):
-                            for tax in app.magento_taxes:
-                                values['tax_class_id'] = tax.tax_id
-                                break
-                        if product_type == 'configurable':
-                            # force visibility Not Visible Individually
-                            values['visibility'] = '1'
-                            # product name from product_name module if installed
-                            values['name'] = product.name if product.name else product.template.name
-                            # each variant add attribute options in product name
-                        if product_type == 'grouped':
-                            # force visibility Not Visible Individually
-                            values['visibility'] = '1'
-
-                        # if products > 1, add code prefix in url key
-                        if total_products > 1:
-                            url_key = values.get('url_key')
-                            values['url_key'] = '%s-%s' % (code.lower(), url_key)
-
-                        if app.debug:
-                            message = 'Magento %s. Product: %s. Values: %s' % (
-                                    self.name, code, values)
-                            logger.info(message)
+                    if product_type in ['configurable', 'grouped']:
+                        # force visibility Not Visible Individually
+                        values['visibility'] = '1'
+                        if values.get('description'):
+                            values['name'] = values['description']
 
-                        mgn_prods = product_api.list({'sku': {'=': code}})
+                    if app.debug:
+                        message = 'Magento %s. Product: %s. Values: %s' % (
+                                self.name, code, values)
+                        logger.info(message)
 
-                        try:
-                            if mgn_prods:
-                                action = 'update'
-                                product_api.update(code, values, identifierType=app.identifier_type)
-                            else:
-                                action = 'create'
-                                del values['sku']
-
-                                # Product type
-                                if product_type == 'configurable':
-                                    magento_product_type = 'simple'
-                                else:
-                                    magento_product_type = product.template.magento_product_type
-
-                                ext_ref = MagentoExternalReferential.get_try2mgn(app,
-                                        'esale.attribute.group',
-                                        template.esale_attribute_group.id)
-                                attribute_mgn = ext_ref.mgn_id
-
-                                mgn_id = product_api.create(magento_product_type, attribute_mgn, code, values)
-
-                                message = 'Magento %s. %s product %s. Magento ID %s' % (
-                                        self.name, action.capitalize(), code, mgn_id)
-                                logger.info(message)
-                        except Exception as e:
-                            action = None
-                            message = 'Magento %s. Error export product %s: %s' % (
-                                        self.name, code, e)
-                            logger.error(message)
+                    key = (str(product), l.storeview.code)
+                    values, digest = changed_values(values,
+                        digests.get(key, {}))
+                    if values:
+                        steps.append({'sku': code, 'method': 'update',
+                                'args': (values, l.storeview.code),
+                                'key': key, 'digest': digest,
+                                'language': l.lang.code})
+
+            # ===========================
+            # Export Configurable Product
+            # ===========================
+            if product_type == 'configurable':
+                if not template.code:
+                    logger.warning('Product Template not have base code')
+                    yield job
+                    continue
 
-                        if not action:
-                            continue
+                if not template.products:
+                    logger.warning('Template not have products')
+                    yield job
+                    continue
+                code = template.code
+                values = Prod.magento_export_product_configurable(app, template, shop=self, lang=language)
+                product = template.products[0]
+                values.update(products_prices[product.id] if product.id
+                    in products_prices else self.magento_get_prices(product))
+
+                key = (str(template), 'default')
+                if code in mgn_skus:
+                    values, digest = changed_values(
+                        values, digests.get(key, {}))
+                    if values:
+                        steps.append({'sku': code, 'method': 'update',
+                                'args': (values, None), 'key': key,
+                                'digest': digest})
+                else:
+                    _, digest = changed_values(values, {})
+                    if attribute_mgn is None:
+                        ext_ref = MagentoExternalReferential.get_try2mgn(app,
+                                'esale.attribute.group',
+                                template.esale_attribute_group.id)
+                        attribute_mgn = ext_ref.mgn_id
+                    steps.append({'sku': code, 'method': 'create',
+                            'args': (template.magento_product_type,
+                                attribute_mgn, values),
+                            'key': key, 'digest': digest})
+                    # set attribute product configuration
+                    steps.append({'sku': code, 'method': 'attributes',
+                            'args': ([a.mgn_id for a in
+                                    template.magento_attribute_configurables],)})
+
+                # Relate product simple to product configuration
+                simples = [p.code for p in template.products if p.code]
+                steps.append({'sku': code, 'method': 'link',
+                        'args': (simples, dict((c, mgn_skus[c])
+                                for c in simples if c in mgn_skus))})
+
+                # save products by language
+                for lang in app.languages:
+                    if language == lang.lang.code:
+                        continue
+                    values = Prod.magento_export_product_configurable(app, template, lang=lang.lang.code)
 
-                        # save products by language
-                        for l in app.languages:
-                            if language == l.lang.code:
-                                continue
-                            values = Prod.magento_export_product(app, product, lang=l.lang.code)
+                    if app.debug:
+                        message = 'Magento %s. Product: %s. Values: %s' % (
+                                self.name, code, values)
+                        logger.info(message)
 
-                            if product_type in ['configurable', 'grouped']:
-                                # force visibility Not Visible Individually
-                                values['visibility'] = '1'
-                                if values.get('description'):
-                                    values['name'] = values['description']
+                    key = (str(template), lang.storeview.code)
+                    values, digest = changed_values(values,
+                        digests.get(key, {}))
+                    if values:
+                        steps.append({'sku': code, 'method': 'update',
+                                'args': (values, lang.storeview.code),
+                                'key': key, 'digest': digest,
+                                'language': lang.lang.code})
+                # END product configuration
+            yield job
 
-                            if app.debug:
-                                message = 'Magento %s. Product: %s. Values: %s' % (
-                                        self.name, code, values)
-                                logger.info(message)
+    @staticmethod
+    def magento_export_step_phase(step):
+        """Phase of an export step: 0 create and default update, 1
+        configurable attributes and links (the products are created) and
+        2 language updates (the default values are saved)
+        :param step: dict
+        :return: int
+        """
+        if step['method'] in ('attributes', 'link'):
+            return 1
+        if step['method'] == 'update' and step['args'][1]:
+            return 2
+        return 0
 
-                            product_api.update(code, values, l.storeview.code, identifierType=app.identifier_type)
+    @staticmethod
+    def magento_run_export_jobs(product_api, jobs):
+        """Run the Magento calls of a group of export jobs by phases (run in
+        threads: not use Tryton records). The updates of a phase of all the
+        jobs are sent by multiCall. When the create/update of a SKU fails,
+        the next calls of the SKU are skipped.
+        :param product_api: Magento Product API
+        :param jobs: list of dict
+        :return: dict with created SKUs (sku: Magento ID), the keys of
+            the steps done and the SKUs not found in Magento
+        """
+        if not jobs:
+            return {'created': {}, 'done': [], 'missing': []}
+        shop = jobs[0]['shop']
+        identifier_type = jobs[0]['identifier_type']
+        # configurable calls use the session of the worker
+        product_conf_api = magento_shared_api(product_api,
+            ProductConfigurable)
+        created = {}
+        done = []
+        failed = set()
+        missing = []
+
+        def send_updates(updates):
+            calls = [('catalog_product.update', (step['sku'],
+                        step['args'][0], step['args'][1], identifier_type))
+                for step in updates]
+            results = magento_multicall(product_api, calls,
+                jobs[0]['multicall_size'])
+            for step, (ok, result) in zip(updates, results):
+                code = step['sku']
+                if not ok:
+                    message = 'Magento %s. Error export product %s: %s' % (
+                                shop, code, result)
+                    logger.error(message)
+                    if not step['args'][1]:
+                        failed.add(code)
+                        if fault_code(result) == PRODUCT_NOT_EXISTS:
+                            # deleted in Magento: created by next export
+                            missing.append(code)
+                    continue
+                if step['args'][1]:
+                    message = 'Magento %s. Update product %s (%s)' % (
+                            shop, code, step['language'])
+                else:
+                    message = 'Magento %s. Update product %s' % (
+                            shop, code)
+                logger.info(message)
+                done.append(step['key'])
 
-                            message = 'Magento %s. Update product %s (%s)' % (
-                                    self.name, code, l.lang.code)
-                            logger.info(message)
+        for phase in range(3):
+            updates = []
+            for job in jobs:
+                for step in job['steps']:
+                    if SaleShop.magento_export_step_phase(step) != phase:
+                        continue
+                    code = step['sku']
+                    method = step['method']
+                    if code in failed:
+                        continue
+                    if method == 'update':
+                        updates.append(step)
+                        continue
+                    try:
+                        if method == 'create':
+                            product_type, attribute_mgn, values = step['args']
+                            mgn_id = product_api.create(product_type, attribute_mgn, code, values)
+                            created[code] = mgn_id
+                            message = 'Magento %s. Create product %s. Magento ID %s' % (
+                                    shop, code, mgn_id)
+                        elif method == 'attributes':
+                            attributes, = step['args']
+                            # assign each magento attribute
+                            for attribute in attributes:
+                                product_conf_api.setSuperAttributeValues(created[code], attribute)
+                            message = 'Magento %s. Set attributes %s to %s' % (
+                                    shop, attributes, code)
+                        elif method == 'link':
+                            codes, mgn_ids = step['args']
+                            simples = [created.get(c) or mgn_ids[c]
+                                for c in codes if c in created or c in mgn_ids]
+                            product_conf_api.update(code, simples, {})
+                            message = 'Magento %s. Update %s with configurable %s' % (
+                                    shop, code, simples)
+                    except Exception as e:
+                        message = 'Magento %s. Error export product %s: %s' % (
+                                    shop, code, e)
+                        logger.error(message)
+                        if method == 'create':
+                            failed.add(code)
+                        continue
+                    logger.info(message)
+                    if step.get('key'):
+                        done.append(step['key'])
+            if updates:
+                send_updates(updates)
+        return {'created': created, 'done': done, 'missing': missing}
 
-                    # ===========================
-                    # Export Configurable Product
-                    # ===========================
-                    if product_type == 'configurable':
-                        if not template.code:
-                            logger.warning('Product Template not have base code')
-                            continue
+    def export_products_magento(self, tpls=[]):
+        """Export Products to Magento
+        Magento calls run in max_connections workers (one Magento session
+        by worker); jobs are built and results are saved in the Tryton
+        transaction, in order, and committed by chunk.
+        :param tpls: list
+        """
+        pool = Pool()
+        Prod = pool.get('product.product')
+        ProductMap = pool.get('magento.product.map')
+        Fingerprint = pool.get('magento.fingerprint')
+        MagentoExternalReferential = pool.get('magento.external.referential')
+        Outbox = pool.get('magento.product.outbox')
 
-                        if not template.products:
-                            logger.warning('Template not have products')
-                            continue
-                        values = Prod.magento_export_product_configurable(app, template, shop=self, lang=language)
-                        prices = self.magento_get_prices(template.products[0])
-                        values.update(prices)
+        product_domain = Prod.magento_product_domain([self.id])
 
-                        mgn_prods = product_api.list({'sku': {'=': code}})
+        context = Transaction().context
 
-                        try:
-                            if mgn_prods:
-                                action = 'update'
-                                product_api.update(code, values, identifierType=app.identifier_type)
-                            else:
-                                action = 'create'
+        outbox_ids = []
+        if tpls:
+            product_domain += [('template.id', 'in', tpls)]
+        else:
+            # products changed (outbox), in order
+            product_ids, outbox_ids = Outbox.pending(self, 'product')
+            product_domain += [('id', 'in', product_ids)]
 
-                                magento_product_type = template.magento_product_type
+        products = Prod.search(product_domain)
+        templates = list(set(p.template for p in products))
 
-                                ext_ref = MagentoExternalReferential.get_try2mgn(app,
-                                        'esale.attribute.group',
-                                        template.esale_attribute_group.id)
-                                attribute_mgn = ext_ref.mgn_id
+        if not templates:
+            logger.info(
+                'Magento %s. Not products to export.' % (self.name))
+            Outbox.drain(self, 'product', outbox_ids)
+            return
 
-                                mgn_id = product_api.create(magento_product_type, attribute_mgn, code, values)
+        logger.info(
+            'Magento %s. Start export %s product(s).' % (
+                self.name, len(templates)))
 
-                                # set attribute product configuration
-                                with ProductConfigurable(app.uri, app.username, app.password) as product_conf_api:
-                                    # assign each magento attribute
-                                    for attribute in template.magento_attribute_configurables:
-                                        product_conf_api.setSuperAttributeValues(mgn_id, attribute.mgn_id)
+        app = self.magento_website.magento_app
+        language = app.default_lang.code or context.get('language')
 
-                                message = 'Magento %s. %s product %s. Magento ID %s' % (
-                                        self.name, action.capitalize(), code, mgn_id)
-                                logger.info(message)
-                        except Exception as e:
-                            message = 'Magento %s. Error export product %s: %s' % (
-                                        self.name, code, e)
-                            logger.error(message)
-                            continue
+        # website referentials are resolved once by run
+        with MagentoExternalReferential.referential_cache():
+            for sub_templates in grouped_slice(templates, EXPORT_CHUNK):
+                sub_templates = list(sub_templates)
 
-                        # Relate product simple to product configuration
-                        ofilter = {'sku': {'in': ['%s' % p.code for p in template.products]}}
-                        products = product_api.list(ofilter)
-                        with ProductConfigurable(app.uri, app.username, app.password) as product_conf_api:
-                            try:
-                                simples = [p['product_id'] for p in products]
-                                product_conf_api.update(code, simples, {})
-                                message = 'Magento %s. Update %s with configurable %s' % (
-                                        self.name, code, simples)
-                                logger.info(message)
-                            except Exception as e:
-                                action = None
-                                message = 'Magento %s. Error export product %s: %s' % (
-                                            self.name, code, e)
-                                logger.error(message)
-
-                        # save products by language
-                        for lang in app.languages:
-                            with Transaction().set_context(language=lang.lang.code):
-                                product = Prod(product.id)
-                                tvals, = BaseExternalMapping.map_tryton_to_external(template_mapping, [product.template.id])
-                            values = tvals
-
-                            if app.debug:
-                                message = 'Magento %s. Product: %s. Values: %s' % (
-                                        self.name, code, values)
-                                logger.info(message)
-
-                            product_api.update(code, values, lang.storeview.code, identifierType=app.identifier_type)
-
-                            message = 'Magento %s. Update product %s (%s)' % (
-                                    self.name, code, lang.lang.code)
-                            logger.info(message)
-                        # END product configuration
+                # products (and configurables) available in Magento
+                codes = []
+                for template in sub_templates:
+                    codes += [p.code for p in template.products if p.code]
+                    if (template.magento_product_type == 'configurable'
+                            and template.code):
+                        codes.append(template.code)
+                mgn_skus = ProductMap.get_map(app, codes)
+                unknown = [c for c in codes if c not in mgn_skus]
+                if unknown:
+                    with magento_api(app, Product) as product_api:
+                        remotes = self.magento_products_by_sku(product_api, unknown)
+                    ProductMap.set_map(app, remotes)
+                    mgn_skus.update(remotes)
+
+                # digests of the last values sent
+                resources = [str(p) for t in sub_templates for p in t.products]
+                resources += [str(t) for t in sub_templates
+                    if t.magento_product_type == 'configurable']
+                digests = Fingerprint.get_digests(app, resources)
+
+                # jobs are built while the workers run the previous groups
+                # of jobs: a group by worker, up to multicall size jobs
+                group_size = max(1, min(app.multicall_size or 1,
+                        -(-len(sub_templates) // MAX_CONNECTIONS)))
+                groups = []
+
+                def chunk_jobs():
+                    for group in chunks(self.magento_export_jobs(app,
+                                sub_templates, mgn_skus, digests, language),
+                            group_size):
+                        groups.append(group)
+                        yield group
+
+                created = {}
+                missing = []
+                to_digest = {}
+                for i, result in enumerate(magento_imap(app, Product,
+                            self.magento_run_export_jobs, chunk_jobs())):
+                    created.update(result['created'])
+                    missing.extend(result['missing'])
+                    steps = dict((step['key'], step['digest'])
+                        for job in groups[i] for step in job['steps']
+                        if step.get('key'))
+                    for key in result['done']:
+                        to_digest[key] = steps[key]
+                    groups[i] = None
+
+                ProductMap.set_map(app, created)
+                ProductMap.remove_map(app, missing)
+                Fingerprint.set_digests(app, to_digest)
+                Transaction().commit()
+
+        Outbox.drain(self, 'product', outbox_ids)
+        Transaction().commit()
 
         logger.info(
             'Magento %s. End export %s product(s).' % (
@@ -376,31 +640,25 @@ class SaleShop(metaclass=PoolMeta):
         pool = Pool()
         Prod = pool.get('product.product')
         MagentoExternalReferential = pool.get('magento.external.referential')
+        Fingerprint = pool.get('magento.fingerprint')
+        Outbox = pool.get('magento.product.outbox')
 
         product_domain = Prod.magento_product_domain([self.id])
 
+        outbox_ids = []
         if tpls:
             product_domain += [('template.id', 'in', tpls)]
         else:
-            now = datetime.datetime.now()
-            last_prices = self.esale_last_prices
-
-            product_domain += [['OR',
-                        ('create_date', '>=', last_prices),
-                        ('write_date', '>=', last_prices),
-                        ('template.create_date', '>=', last_prices),
-                        ('template.write_date', '>=', last_prices),
-                    ]]
-
-            # Update date last import
-            self.write([self], {'esale_last_prices': now})
-            Transaction().commit()
+            # products changed (outbox), in order
+            product_ids, outbox_ids = Outbox.pending(self, 'price')
+            product_domain += [('id', 'in', product_ids)]
 
         products = Prod.search(product_domain)
 
         if not products:
             logger.info(
                 'Magento %s. Not products to export prices.' % (self.name))
+            Outbox.drain(self, 'price', outbox_ids)
             return
 
         logger.info(
@@ -409,39 +667,77 @@ class SaleShop(metaclass=PoolMeta):
 
         app = self.magento_website.magento_app
 
-        for sub_products in grouped_slice(products, MAX_CONNECTIONS):
-            with Product(app.uri, app.username, app.password) as product_api:
+        with MagentoExternalReferential.referential_cache():
+            magento_website = None
+            if app.catalog_price == 'website':
+                ext_ref = MagentoExternalReferential.get_try2mgn(app,
+                        'magento.external.referential',
+                        self.magento_website.id)
+                magento_website = ext_ref.mgn_id
+
+            # price scopes: website and/or global
+            if app.catalog_price == 'website':
+                scopes = [('price-%s' % magento_website, magento_website)]
+                if self.magento_price_global: # Global price
+                    scopes.append(('price', None))
+            else:
+                scopes = [('price', None)]
+
+            unchanged = 0
+            for sub_products in grouped_slice(products, EXPORT_CHUNK):
+                sub_products = [p for p in sub_products if p.code]
+                products_prices = self.magento_get_products_prices(sub_products)
+                # last prices exported (snapshot)
+                fingerprints = Fingerprint.get_fingerprints(app,
+                    [str(p) for p in sub_products])
+
+                calls = []
                 for product in sub_products:
-                    if not product.code:
-                        continue
                     code = product.code
 
-                    data = self.magento_get_prices(product)
+                    data = products_prices[product.id]
+                    value = fingerprint(data)
 
-                    if app.debug:
-                        message = 'Magento %s. Product: %s. Data: %s' % (
-                                self.name, code, data)
-                        logger.info(message)
+                    for scope, store in scopes:
+                        key = (str(product), scope)
+                        if fingerprints.get(key) == value:
+                            unchanged += 1
+                            continue
+                        if app.debug:
+                            message = 'Magento %s. Product: %s. Data: %s' % (
+                                    self.name, code, data)
+                            logger.info(message)
+                        calls.append((('catalog_product.update',
+                                    (code, data, store, app.identifier_type)),
+                                (code, key, value)))
 
-                    try:
-                        if app.catalog_price == 'website':
-                            ext_ref = MagentoExternalReferential.get_try2mgn(app,
-                                    'magento.external.referential',
-                                    self.magento_website.id)
-                            magento_website = ext_ref.mgn_id
-                            product_api.update(code, data, magento_website, identifierType=app.identifier_type)
-                            if self.magento_price_global: # Global price
-                                product_api.update(code, data, identifierType=app.identifier_type)
-                        else:
-                            product_api.update(code, data, identifierType=app.identifier_type)
+                if not calls:
+                    continue
+
+                with magento_api(app, Product) as product_api:
+                    results = magento_multicall(product_api,
+                        [call for call, _ in calls], app.multicall_size)
 
+                to_fingerprint = {}
+                for (_, (code, key, value)), (ok, result) in zip(calls, results):
+                    if ok:
+                        to_fingerprint[key] = value
                         message = 'Magento %s. Export price %s product.' % (
                                 self.name, code)
                         logger.info(message)
-                    except Exception as e:
+                    else:
                         message = 'Magento %s. Error export prices to product %s: %s' % (
-                                    self.name, code, e)
+                                    self.name, code, result)
                         logger.error(message)
+                Fingerprint.set_fingerprints(app, to_fingerprint)
+                Transaction().commit()
+
+        if unchanged:
+            logger.info('Magento %s. %s product prices not changed.' % (
+                    self.name, unchanged))
+
+        Outbox.drain(self, 'price', outbox_ids)
+        Transaction().commit()
 
         logger.info(
             'Magento %s. End export prices %s products.' % (
@@ -452,26 +748,19 @@ class SaleShop(metaclass=PoolMeta):
         :param shop: object
         :param tpls: list
         """
-        Prod = Pool().get('product.product')
+        pool = Pool()
+        Prod = pool.get('product.product')
+        Outbox = pool.get('magento.product.outbox')
 
         product_domain = Prod.magento_product_domain([self.id])
 
+        outbox_ids = []
         if tpls:
             product_domain += [('template.id', 'in', tpls)]
         else:
-            now = datetime.datetime.now()
-            last_images = self.esale_last_images
-
-            product_domain += [['OR',
-                        ('create_date', '>=', last_images),
-                        ('write_date', '>=', last_images),
-                        ('template.create_date', '>=', last_images),
-                        ('template.write_date', '>=', last_images),
-                    ]]
-
-            # Update date last import
-            self.write([self], {'esale_last_images': now})
-            Transaction().commit()
+            # products changed (outbox), in order
+            product_ids, outbox_ids = Outbox.pending(self, 'image')
+            product_domain += [('id', 'in', product_ids)]
 
         products = Prod.search(product_domain)
         templates = list(set(p.template for p in products))
@@ -479,6 +768,7 @@ class SaleShop(metaclass=PoolMeta):
         if not templates:
             logger.info(
                 'Magento %s. Not product images to export.' % (self.name))
+            Outbox.drain(self, 'image', outbox_ids)
             return
 
         logger.info(
@@ -487,41 +777,36 @@ class SaleShop(metaclass=PoolMeta):
 
         app = self.magento_website.magento_app
 
-        for sub_templates in grouped_slice(templates, MAX_CONNECTIONS):
-            for template in sub_templates:
-                if not template.products:
-                    continue
-
-                if template.magento_product_type == 'configurable':
-                    # template -> configurable
-                    if template.attachments:
-                        code = template.code
-                        if code:
-                            images = self.magento_images_from_attachments(template.attachments)
-                            if images:
-                                self.create_update_magento_images(app, self, code, images)
-                    # variants -> simple
-                    for product in template.products:
-                        if not product.attachments:
-                            continue
-                        if not product.code:
-                            continue
-                        code = product.code
-                        images = self.magento_images_from_attachments(product.attachments)
-                        if images:
-                            self.create_update_magento_images(app, self, code, images)
-                elif template.attachments:
-                    if not template.attachments:
-                        continue
-                    product, = template.products
-                    if not product.code:
-                        continue
-                    code = product.code
-                    images = self.magento_images_from_attachments(template.attachments)
-                    if images:
-                        self.create_update_magento_images(app, self, code, images)
-                else:
-                    continue
+        # SKUs and attachments (template -> configurable, variants -> simple)
+        items = []
+        for template in templates:
+            if not template.products:
+                continue
+
+            if template.magento_product_type == 'configurable':
+                if template.attachments and template.code:
+                    items.append((template.code, template.attachments))
+                for product in template.products:
+                    if product.attachments and product.code:
+                        items.append((product.code, product.attachments))
+            elif template.attachments:
+                product, = template.products
+                if product.code:
+                    items.append((product.code, template.attachments))
+
+        for sub_items in grouped_slice(items, EXPORT_CHUNK):
+            to_export = []
+            for code, attachments in sub_items:
+                images = self.magento_images_from_attachments(attachments)
+                if images:
+                    to_export.append((code, images))
+            try:
+                self.magento_export_images(app, to_export)
+            finally:
+                Transaction().commit()
+
+        Outbox.drain(self, 'image', outbox_ids)
+        Transaction().commit()
 
         logger.info(
             'Magento %s. End export images %s products.' % (
@@ -529,6 +814,14 @@ class SaleShop(metaclass=PoolMeta):
 
     @staticmethod
     def magento_images_from_attachments(attachments):
+        '''Images values of attachments. Image data is not loaded: only the
+        size (read from the filestore) and it is read when uploaded'''
+        Attachment = Pool().get('ir.attachment')
+
+        with Transaction().set_context({'ir.attachment.data': 'size'}):
+            sizes = dict((a.id, a.data or 0) for a in Attachment.browse(
+                    [a.id for a in attachments if a.esale_available]))
+
         images = []
         for attachment in attachments:
             if attachment.esale_available:
@@ -561,7 +854,7 @@ class SaleShop(metaclass=PoolMeta):
                 data['position'] = attachment.esale_position
                 data['exclude'] = attachment.esale_exclude
                 data['types'] = types
-                data['data'] = attachment.data
+                data['size'] = sizes[attachment.id]
                 data['name'] = attachment.name.split('.')[0] #remove ext file
                 data['file'] = '/%s/%s/%s' % (
                         attachment.name[0],
@@ -570,79 +863,349 @@ class SaleShop(metaclass=PoolMeta):
                         ) # m/y/my_image.jpg
                 data['mime'] = mime
                 data['attachment'] = attachment
+                # filestore ID is the digest of the data
+                data['digest'] = attachment.file_id or str(data['size'])
                 images.append(data)
         return images
 
     @staticmethod
-    def create_update_magento_images(app, shop, code, images):
-        '''Create/Update image by code product'''
-        pool = Pool()
-        Attachment = pool.get('ir.attachment')
+    def magento_image_prefix():
+        '''Filestore prefix of the attachments data: as the Binary field,
+        the store prefix of the field or the database name'''
+        Attachment = Pool().get('ir.attachment')
+        prefix = Attachment.data.store_prefix
+        if prefix is None:
+            prefix = Transaction().database.name
+        return prefix
 
-        with ProductImages(app.uri, app.username, app.password) as product_image_api:
-            # find images available every product
-            creates = []
-            updates = []
+    @staticmethod
+    def magento_image_source(attachment, prefix):
+        '''Source of the image data of the attachment, read later by the
+        worker with magento_image_data: the filestore ID or, when the data
+        is not in the filestore, the attachment ID
+        :param attachment: object
+        :param prefix: str (magento_image_prefix)
+        '''
+        transaction = Transaction()
+        if attachment.file_id:
+            return ('file', attachment.file_id, prefix)
+        return ('attachment', attachment.id, transaction.database.name,
+            transaction.user)
 
-            mgn_imgs = product_image_api.list(code, identifierType=app.identifier_type)
-            for image in images:
-                if image.get('file') in [mgn_img.get('file') for mgn_img in mgn_imgs]:
-                    updates.append(image)
-                else:
-                    creates.append(image)
+    @staticmethod
+    def magento_image_data(source):
+        '''Image data of a source (run in threads: attachments are read in
+        a new transaction of the worker)
+        :param source: tuple ('file', file ID, prefix) or ('attachment',
+            attachment ID, database, user)
+        '''
+        if source[0] == 'file':
+            _, file_id, prefix = source
+            return filestore.get(file_id, prefix=prefix) or b''
+        _, attachment_id, database, user = source
+        with Transaction().start(database, user, readonly=True):
+            Attachment = Pool().get('ir.attachment')
+            return Attachment(attachment_id).data or b''
+
+    def magento_image_settings(self):
+        '''Resize and compress settings of the images
+        :return: tuple (max dimension, quality) or None
+        '''
+        if not self.magento_image_transform:
+            return None
+        if Image is None:
+            logger.error('Magento %s. Images are exported without '
+                'transform: Pillow is not installed.' % self.name)
+            return None
+        return (self.magento_image_max_dimension or None,
+            self.magento_image_quality or 85)
 
-            # Update images
-            for data in updates:
-                filename = data['file']
-                img_data = {}
-                img_data['label'] = data['label']
-                img_data['position'] = data['position']
-                img_data['exclude'] = data['exclude']
-                img_data['types'] = data['types']
+    @staticmethod
+    def magento_images_plan(code, images, mgn_imgs, states):
+        """Operations to sync the images of a SKU: compare the last uploaded
+        image (digest and metadata) of every attachment with the Magento
+        images. Not use Tryton records (run in threads)
+        :param code: str
+        :param images: list of dict (magento_images_from_attachments)
+        :param mgn_imgs: list of dict (Magento images list)
+        :param states: dict (resource, scope): last uploaded state
+        :return: list of tuples (method, image, Magento file, state)
+            method: create (upload), replace (upload new data and remove
+            the old file) or update (metadata)
+        """
+        remotes = set(mgn_img.get('file') for mgn_img in mgn_imgs)
+        plan = []
+        for image in images:
+            img_data = {}
+            img_data['label'] = image['label']
+            img_data['position'] = image['position']
+            img_data['exclude'] = image['exclude']
+            img_data['types'] = image['types']
+            image['img_data'] = img_data
+
+            key = (image['resource'], 'image-%s' % code)
+            state = states.get(key) or {}
+            new_state = {
+                'content': image['digest'],
+                'metadata': fingerprint(img_data)[:12],
+                }
+            filename = state.get('file')
+            if filename not in remotes:
+                filename = image['file']
+
+            if filename not in remotes:
+                method = 'create'
+            elif state and state.get('content') != new_state['content']:
+                method = 'replace'
+            elif state.get('metadata') != new_state['metadata']:
+                method = 'update'
+            else:
+                continue
+            new_state['file'] = filename
+            plan.append((method, image, filename, (key, new_state)))
+        return plan
+
+    @staticmethod
+    def magento_list_images(product_image_api, item):
+        '''Magento images of a SKU (run in threads)
+        :param item: tuple (code, identifier type)
+        '''
+        code, identifier_type = item
+        try:
+            return product_image_api.list(code, identifierType=identifier_type)
+        except Exception as e:
+            logger.error('Magento. Error list images product %s: %s' % (
+                    code, e))
+            return None
 
+    @staticmethod
+    def magento_run_images_job(product_image_api, job):
+        """Run the image operations of a SKU in order: upload (create), set
+        metadata (update) and remove the replaced file (run in threads: not
+        use Tryton records)
+        :param product_image_api: Magento ProductImages API
+        :param job: dict
+        :return: dict with the attachments to rename (ID: name), the
+            states of the operations done and the transformed images
+        """
+        shop = job['shop']
+        code = job['code']
+        renames = {}
+        states = {}
+        transformed = {}
+        for op in job['ops']:
+            method = op['method']
+            filename = op['file']
+            key, state = op['state']
+            if method == 'update':
                 try:
-                    product_image_api.update(code, filename, img_data)
+                    product_image_api.update(code, filename, op['img_data'])
                     message = 'Magento %s. Updated image %s product %s.' % (
-                            shop.name, filename, code)
+                            shop, filename, code)
                     logger.info(message)
+                    states[key] = state
                 except Exception as e:
                     message = 'Magento %s. Error update image %s to product %s: %s' % (
-                                shop.name, filename, code, e)
+                                shop, filename, code, e)
                     logger.error(message)
+                continue
+
+            # bound the image bytes in use of all workers until it is sent
+            with job['memory'].reserve(op['size'] * _IMAGE_COPIES):
+                result = SaleShop.magento_send_image(product_image_api, job,
+                    op)
+            if result:
+                renames.update(result['renames'])
+                states.update(result['states'])
+                transformed.update(result['transformed'])
+        return {'renames': renames, 'states': states,
+            'transformed': transformed}
+
+    @staticmethod
+    def magento_send_image(product_image_api, job, op):
+        """Read, transform and upload an image operation (create or replace)
+        of magento_run_images_job (run in threads: not use Tryton records)
+        :param product_image_api: Magento ProductImages API
+        :param job: dict
+        :param op: dict
+        :return: dict (as magento_run_images_job) or None
+        """
+        shop = job['shop']
+        code = job['code']
+        identifier_type = job['identifier_type']
+        method = op['method']
+        filename = op['file']
+        key, state = op['state']
+        renames = {}
+        states = {}
+        transformed = {}
+        try:
+            data = SaleShop.magento_image_data(op['source'])
+        except Exception as e:
+            message = 'Magento %s. Error read image %s product %s: %s' % (
+                shop, op['name'], code, e)
+            logger.error(message)
+            return None
+        transform = op.get('transform')
+        if transform:
+            try:
+                data = image_transform(data, op['mime'],
+                    transform['max_dimension'], transform['quality'])
+                # cache the transformed image in the filestore
+                file_id = filestore.set(data, prefix=op['prefix'])
+                transformed[transform['key']] = {
+                    'source': transform['digest'],
+                    'file_id': file_id,
+                    }
+            except Exception as e:
+                message = 'Magento %s. Error transform image %s ' \
+                    'product %s: %s' % (shop, op['name'], code, e)
+                logger.error(message)
+        try:
+            fdata = {'file': {
+                'content': base64.b64encode(data),
+                'name': op['name'],
+                'mime': op['mime'],
+                }}
+            del data
+            mgn_img = product_image_api.create(code, fdata, identifierType=identifier_type)
+            product_image_api.update(code, mgn_img, op['img_data'], identifierType=identifier_type)
+            if method == 'replace':
+                product_image_api.remove(code, filename,
+                    identifierType=identifier_type)
+            new_name = mgn_img.split('/')[-1]
+            renames[op['attachment']] = new_name
+            state['file'] = mgn_img
+            states[key] = state
+            message = 'Magento %s. Created image %s product %s.' % (
+                    shop, new_name, code)
+            logger.info(message)
+        except Exception as e:
+            message = 'Magento %s. Error create image %s to product %s: %s' % (
+                        shop, filename, code, e)
+            logger.error(message)
+        return {'renames': renames, 'states': states,
+            'transformed': transformed}
+
+    def magento_export_images(self, app, items):
+        """Export images of SKUs: Magento images are listed and images are
+        sent in max_connections workers (one Magento session by worker). The
+        operations of a SKU run in order in the same worker; SKUs run in
+        parallel. Image data is read by the worker that sends it.
+        :param app: object
+        :param items: list of tuples (code, images)
+        """
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+        Fingerprint = pool.get('magento.fingerprint')
+
+        if not items:
+            return
+
+        prefix = self.magento_image_prefix()
+        settings = self.magento_image_settings()
+        if settings:
+            # transformed images are cached by source digest and settings
+            cache_scope = 'image-transform-%s-%s' % settings
 
-            # Create images
-            for data in creates:
-                filedata = data.get('data')
-                if not filedata:
+        for code, images in items:
+            for image in images:
+                image['resource'] = str(image['attachment'])
+                image['source_digest'] = image['digest']
+                if settings:
+                    # new settings upload the images again
+                    image['digest'] = '%s-%s' % (image['digest'],
+                        cache_scope)
+        states = Fingerprint.get_digests(app,
+            [image['resource'] for _, images in items for image in images])
+        memory = ByteSemaphore(IMAGE_MEMORY)
+
+        mgn_imgs = magento_imap(app, ProductImages, self.magento_list_images,
+            [(code, app.identifier_type) for code, _ in items])
+
+        def jobs():
+            # sources are read while the workers send the previous jobs
+            for (code, images), remotes in zip(items, mgn_imgs):
+                if remotes is None:
                     continue
+                ops = []
+                for method, data, filename, state in self.magento_images_plan(
+                        code, images, remotes, states):
+                    op = {
+                        'method': method,
+                        'file': filename,
+                        'img_data': data['img_data'],
+                        'state': state,
+                        }
+                    if method in ('create', 'replace'):
+                        if not data['size']:
+                            continue
+                        # transformed images are shrunk before they are sent
+                        if (IMAGE_SKIP_SIZE and data['size'] > IMAGE_SKIP_SIZE
+                                and not settings):
+                            message = 'Magento %s. Error create image %s to ' \
+                                'product %s: size %s is greater than %s' % (
+                                    self.name, filename, code, data['size'],
+                                    IMAGE_SKIP_SIZE)
+                            logger.error(message)
+                            continue
+                        op.update({
+                            'size': data['size'],
+                            'source': self.magento_image_source(
+                                data['attachment'], prefix),
+                            'prefix': prefix,
+                            'name': data['name'],
+                            'mime': data['mime'],
+                            'attachment': data['attachment'].id,
+                            })
+                        if settings:
+                            key = (data['resource'], cache_scope)
+                            cache = states.get(key, {})
+                            if (cache.get('source') == data['source_digest']
+                                    and cache.get('file_id')):
+                                op['source'] = ('file', cache['file_id'], prefix)
+                            else:
+                                op['transform'] = {
+                                    'max_dimension': settings[0],
+                                    'quality': settings[1],
+                                    'key': key,
+                                    'digest': data['source_digest'],
+                                    }
+                    ops.append(op)
+                if ops:
+                    yield {
+                        'shop': self.name,
+                        'code': code,
+                        'identifier_type': app.identifier_type,
+                        'memory': memory,
+                        'ops': ops,
+                        }
+
+        renames = {}
+        to_state = {}
+        try:
+            for result in magento_imap(app, ProductImages,
+                    self.magento_run_images_job, jobs()):
+                renames.update(result['renames'])
+                to_state.update(result['states'])
+                to_state.update(result['transformed'])
+        finally:
+            # save the images sent, also when the export is aborted: they
+            # are not uploaded again the next export
+            if renames:
+                to_write = []
+                for attachment_id, name in renames.items():
+                    to_write.extend(
+                        ([Attachment(attachment_id)], {'name': name}))
+                with Transaction().set_context(magento_outbox=False):
+                    Attachment.write(*to_write)
+            Fingerprint.set_digests(app, to_state)
 
-                name = data['name']
-                filename = data['file']
-                mime = data['mime']
-                attachment = data['attachment']
-                img_data = {}
-                img_data['label'] = data['label']
-                img_data['position'] = data['position']
-                img_data['exclude'] = data['exclude']
-                img_data['types'] = data['types']
-
-                fdata = {'file': {
-                    'content': base64.b64encode(filedata),
-                    'name': name,
-                    'mime': mime,
-                    }}
-                try:
-                    mgn_img = product_image_api.create(code, fdata, identifierType=app.identifier_type)
-                    product_image_api.update(code, mgn_img, img_data, identifierType=app.identifier_type)
-                    new_name = mgn_img.split('/')[-1]
-                    Attachment.write([attachment], {'name': new_name})
-                    message = 'Magento %s. Created image %s product %s.' % (
-                            shop.name, new_name, code)
-                    logger.info(message)
-                except Exception as e:
-                    message = 'Magento %s. Error create image %s to product %s: %s' % (
-                                shop.name, filename, code, e)
-                    logger.error(message)
+    @staticmethod
+    def create_update_magento_images(app, shop, code, images):
+        '''Create/Update image by code product: only the new images, the
+        images with new data and the images with new metadata'''
+        shop.magento_export_images(app, [(code, images)])
 
     def export_menus_magento(self, tpls=[]):
         """Export Menus to Magento
@@ -2,8 +2,16 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 import unittest
+from contextlib import contextmanager
+from io import BytesIO
+from unittest import mock
+from xmlrpc.client import Fault
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import ModuleTestCase
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 
 class MagentoProductTestCase(ModuleTestCase):
@@ -11,8 +19,408 @@ class MagentoProductTestCase(ModuleTestCase):
     module = 'magento_product'
 
 
+class FakeAPI(object):
+    'Magento API that records the calls'
+
+    url = 'http://localhost/index.php/api/xmlrpc'
+    username = password = 'test'
+    client = session = None
+
+    def __init__(self, faults=None):
+        self.faults = faults or {}
+        self.calls = []
+        self.multicalls = []
+
+    def call(self, resource_path, arguments):
+        self.calls.append((resource_path, arguments))
+        if arguments[0] in self.faults:
+            raise Fault(self.faults[arguments[0]], 'Error')
+        return True
+
+    def multiCall(self, calls):
+        self.multicalls.append(calls)
+        results = []
+        for resource_path, arguments in calls:
+            if arguments[0] in self.faults:
+                results.append({
+                        'isFault': True,
+                        'faultCode': self.faults[arguments[0]],
+                        'faultMessage': 'Error',
+                        })
+            else:
+                results.append(True)
+        return results
+
+
+class MagentoProductToolsTestCase(unittest.TestCase):
+    'Test Magento Product helpers (no database)'
+
+    def test_images_plan(self):
+        'Test images plan: create, no-op, update and replace'
+        from trytond.modules.magento_product.shop import SaleShop
+
+        def images(label='Image', digest='abc'):
+            return [{
+                    'resource': 'ir.attachment,1',
+                    'label': label,
+                    'position': 1,
+                    'exclude': False,
+                    'types': ['image'],
+                    'digest': digest,
+                    'file': '/i/m/image.jpg',
+                    }]
+
+        # first run: create
+        plan = SaleShop.magento_images_plan('SKU', images(), [], {})
+        self.assertEqual([p[0] for p in plan], ['create'])
+        _, _, _, (key, state) = plan[0]
+        state['file'] = '/i/m/image_1.jpg'
+        states = {key: state}
+        mgn_imgs = [{'file': '/i/m/image_1.jpg'}]
+
+        # second run: no operations
+        plan = SaleShop.magento_images_plan('SKU', images(), mgn_imgs,
+            states)
+        self.assertEqual(plan, [])
+
+        # new metadata: update
+        plan = SaleShop.magento_images_plan('SKU', images(label='New'),
+            mgn_imgs, states)
+        self.assertEqual([(p[0], p[2]) for p in plan],
+            [('update', '/i/m/image_1.jpg')])
+
+        # new data: replace
+        plan = SaleShop.magento_images_plan('SKU', images(digest='def'),
+            mgn_imgs, states)
+        self.assertEqual([(p[0], p[2]) for p in plan],
+            [('replace', '/i/m/image_1.jpg')])
+
+        # removed in Magento: create
+        plan = SaleShop.magento_images_plan('SKU', images(), [], states)
+        self.assertEqual([p[0] for p in plan], ['create'])
+
+    def test_products_by_id(self):
+        'Test product windows by ID and the cursor saved by window'
+        from trytond.modules.magento_product import magento_core
+        lists = []
+
+        @contextmanager
+        def magento_api(app, api_class):
+            product_api = mock.Mock()
+            product_api.list.side_effect = lambda ofilter: (
+                lists.append(ofilter['entity_id']) or [])
+            yield product_api
+
+        app = mock.Mock(from_id_products=1, to_id_products=5)
+        with mock.patch.object(magento_core, 'magento_api', magento_api), \
+                mock.patch.object(magento_core, 'IMPORT_WINDOW', 2):
+            windows = list(
+                magento_core.MagentoApp.magento_products_by_id(app))
+        self.assertEqual(lists, [
+                {'from': 1, 'to': 2},
+                {'from': 3, 'to': 4},
+                {'from': 5, 'to': 5},
+                ])
+        self.assertEqual([data for _, data in windows], [
+                {'from_id_products': 3},
+                {'from_id_products': 5},
+                {'from_id_products': 6, 'to_id_products': None},
+                ])
+
+    def test_merge_products(self):
+        'Test merge product lists keeps the newest product'
+        from trytond.modules.magento_product.magento_core import MagentoApp
+        products, duplicates = MagentoApp.magento_merge_products([
+                {'product_id': '1', 'updated_at': '2020-01-01 00:00:00'},
+                {'product_id': '2', 'updated_at': '2020-01-01 00:00:00'},
+                ], [
+                {'product_id': '1', 'updated_at': '2020-02-01 00:00:00'},
+                {'product_id': '2', 'updated_at': '2019-01-01 00:00:00'},
+                ])
+        self.assertEqual(duplicates, 2)
+        products = dict((p['product_id'], p['updated_at']) for p in products)
+        self.assertEqual(products, {
+                '1': '2020-02-01 00:00:00',
+                '2': '2020-01-01 00:00:00',
+                })
+
+    def test_category_nodes(self):
+        'Test category nodes: parents before children'
+        from trytond.modules.magento_product.magento_core import MagentoApp
+        tree = {'category_id': '1', 'children': [
+                {'category_id': '2', 'children': [
+                        {'category_id': '4', 'children': []},
+                        ]},
+                {'category_id': '3', 'children': []},
+                ]}
+        nodes = MagentoApp.magento_category_nodes(tree)
+        self.assertEqual(nodes[0], ('1', None))
+        position = dict((c, i) for i, (c, _) in enumerate(nodes))
+        for category_id, parent_id in nodes:
+            if parent_id is not None:
+                self.assertLess(position[parent_id], position[category_id])
+        self.assertEqual(len(nodes), 4)
+
+    def test_changed_values(self):
+        'Test changed values by digest'
+        from trytond.modules.magento_product.tools import changed_values
+        values = {'name': 'Product', 'price': '10.0'}
+        changed, digests = changed_values(values, {})
+        self.assertEqual(changed, values)
+
+        changed, new_digests = changed_values(values, digests)
+        self.assertEqual(changed, {})
+        self.assertEqual(new_digests, digests)
+
+        values['price'] = '12.0'
+        changed, _ = changed_values(values, digests)
+        self.assertEqual(changed, {'price': '12.0'})
+
+    def test_export_job_failed_update(self):
+        'Test language updates of a SKU with a failed update are skipped'
+        from trytond.modules.magento_product.shop import SaleShop
+        api = FakeAPI(faults={'A': 101})
+        job = {
+            'shop': 'Shop',
+            'identifier_type': 'sku',
+            'multicall_size': 50,
+            'steps': [
+                {'sku': 'A', 'method': 'update', 'args': ({}, None),
+                    'key': 'A'},
+                {'sku': 'A', 'method': 'update', 'args': ({}, 'es'),
+                    'key': 'A-es', 'language': 'es_ES'},
+                {'sku': 'B', 'method': 'update', 'args': ({}, None),
+                    'key': 'B'},
+                {'sku': 'B', 'method': 'update', 'args': ({}, 'es'),
+                    'key': 'B-es', 'language': 'es_ES'},
+                ],
+            }
+        result = SaleShop.magento_run_export_jobs(api, [job])
+        sent = [(c[1][0], c[1][2]) for calls in api.multicalls
+            for c in calls]
+        self.assertNotIn(('A', 'es'), sent)
+        self.assertEqual(result['done'], ['B', 'B-es'])
+        self.assertEqual(result['missing'], ['A'])
+
+    def test_shared_api(self):
+        'Test the shared API uses the session of the worker API'
+        from magento import Product, ProductConfigurable
+        from trytond.modules.magento_product.tools import magento_shared_api
+        product_api = Product('http://localhost', 'test', 'test')
+        product_api.client = mock.Mock()
+        product_api.session = 'session'
+        conf_api = magento_shared_api(product_api, ProductConfigurable)
+        self.assertIsInstance(conf_api, ProductConfigurable)
+        self.assertIs(conf_api.client, product_api.client)
+        self.assertEqual(conf_api.session, 'session')
+        self.assertEqual(conf_api.url, product_api.url)
+
+    def test_session_login_again(self):
+        'Test the session logs in again when Magento expires it'
+        from trytond.modules.magento_product import tools
+        server = mock.Mock()
+        server.login.side_effect = ['session-1', 'session-2']
+        server.call.side_effect = [Fault(5, 'Session expired'), 'result',
+            Fault(101, 'Product not exists')]
+        with mock.patch.object(tools, 'API') as API:
+            API.return_value.client = server
+            session = tools.MagentoSession('http://localhost', 'test', 'test')
+        self.assertEqual(session.call(session.session, 'catalog_product.info',
+                ['A']), 'result')
+        self.assertEqual(server.login.call_count, 2)
+        self.assertEqual(session.session, 'session-2')
+        self.assertEqual(server.call.call_args[0][0], 'session-2')
+        # other faults are raised
+        with self.assertRaises(Fault):
+            session.call(session.session, 'catalog_product.info', ['B'])
+        self.assertEqual(server.login.call_count, 2)
+
+    def test_session_pool_reuse(self):
+        'Test the session pool reuses the sessions'
+        from magento import Product, Category
+        from trytond.modules.magento_product import tools
+        with mock.patch.object(tools, 'MagentoSession') as MagentoSession:
+            pool = tools.MagentoSessionPool('http://localhost', 'test',
+                'test', size=2)
+            with pool.api(Product) as product_api:
+                pass
+            with pool.api(Category) as category_api:
+                self.assertIs(category_api.client, product_api.client)
+        self.assertEqual(MagentoSession.call_count, 1)
+
+    def test_multicall_faults(self):
+        'Test multiCall maps the faults to every call'
+        from trytond.modules.magento_product.tools import (
+            magento_multicall, fault_code)
+        api = FakeAPI(faults={'B': 101})
+        calls = [('catalog_product.update', (c, {})) for c in 'ABC']
+        results = magento_multicall(api, calls, 2)
+        self.assertEqual(len(api.multicalls), 2)
+        self.assertEqual(api.calls, [])
+        self.assertEqual([ok for ok, _ in results], [True, False, True])
+        self.assertEqual(fault_code(results[1][1]), 101)
+
+    def test_multicall_one_call(self):
+        'Test one call by update when size is lower than 2'
+        from trytond.modules.magento_product.tools import (
+            magento_multicall, fault_code)
+        api = FakeAPI(faults={'A': 101})
+        calls = [('catalog_product.update', (c, {})) for c in 'AB']
+        results = magento_multicall(api, calls, 1)
+        self.assertEqual(api.multicalls, [])
+        self.assertEqual(len(api.calls), 2)
+        self.assertEqual([ok for ok, _ in results], [False, True])
+        self.assertEqual(fault_code(results[0][1]), 101)
+
+    def test_export_jobs_batch(self):
+        'Test updates of a group of jobs are sent by phases in one multiCall'
+        from trytond.modules.magento_product.shop import SaleShop
+        api = FakeAPI()
+
+        def job(code):
+            return {
+                'shop': 'Shop',
+                'identifier_type': 'sku',
+                'multicall_size': 50,
+                'steps': [
+                    {'sku': code, 'method': 'update', 'args': ({}, None),
+                        'key': code},
+                    {'sku': code, 'method': 'update', 'args': ({}, 'es'),
+                        'key': '%s-es' % code, 'language': 'es_ES'},
+                    ],
+                }
+        result = SaleShop.magento_run_export_jobs(api, [job('A'), job('B')])
+        sent = [[(c[1][0], c[1][2]) for c in calls]
+            for calls in api.multicalls]
+        self.assertEqual(sent, [
+                [('A', None), ('B', None)],
+                [('A', 'es'), ('B', 'es')],
+                ])
+        self.assertEqual(result['done'], ['A', 'B', 'A-es', 'B-es'])
+
+    def test_products_prices(self):
+        'Test prices by batch are the prices by product'
+        from decimal import Decimal
+        from trytond.modules.magento_product import shop as shop_module
+        SaleShop = shop_module.SaleShop
+
+        class Shop(object):
+            magento_get_prices = SaleShop.magento_get_prices
+            magento_get_products_prices = SaleShop.magento_get_products_prices
+            magento_prices_w_taxes = SaleShop.magento_prices_w_taxes
+            esale_price = 'pricelist'
+            price_list = mock.Mock(id=1)
+            esale_price_party = mock.Mock(id=1)
+            esale_tax_include = True
+            magento_shop_group_prices = []
+            taxes = 0
+
+            def esale_price_w_taxes(self, product, price, quantity):
+                self.taxes += 1
+                return price * Decimal('1.21')
+
+        def get_sale_price(products, quantity):
+            return dict((p.id, Decimal(p.id % 2 * 10 + 10))
+                for p in products)
+
+        tax = mock.Mock(id=1)
+        products = [mock.Mock(id=i, magento_group_price=False,
+                template=mock.Mock(customer_taxes_used=[tax]))
+            for i in range(1, 5)]
+        Product = mock.Mock()
+        Product.get_sale_price.side_effect = get_sale_price
+        with mock.patch.object(shop_module, 'Pool') as Pool, \
+                mock.patch.object(shop_module, 'Transaction'):
+            Pool.return_value.get.return_value = Product
+            shop = Shop()
+            prices = shop.magento_get_products_prices(products)
+            self.assertEqual(Product.get_sale_price.call_count, 1)
+            # products with the same taxes and price are computed once
+            self.assertEqual(shop.taxes, 2)
+            for product in products:
+                self.assertEqual(prices[product.id],
+                    shop.magento_get_prices(product))
+        self.assertEqual(prices[1]['price'],
+            str(Decimal(20) * Decimal('1.21')))
+        self.assertEqual(prices[2]['price'],
+            str(Decimal(10) * Decimal('1.21')))
+
+    @unittest.skipIf(Image is None, 'Pillow is not installed')
+    def test_image_transform(self):
+        'Test image transform: resize, EXIF orientation and not smaller'
+        from trytond.modules.magento_product.tools import image_transform
+
+        def image_data(size, format_, **kwargs):
+            output = BytesIO()
+            Image.new('RGB', size, (200, 10, 10)).save(output, format_,
+                **kwargs)
+            return output.getvalue()
+
+        data = image_data((200, 100), 'JPEG')
+        result = image_transform(data, 'image/jpeg', 50, 80)
+        image = Image.open(BytesIO(result))
+        self.assertEqual(image.format, 'JPEG')
+        self.assertEqual(image.size, (50, 25))
+
+        # rotate 90 (EXIF orientation 6)
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        data = image_data((100, 50), 'JPEG', exif=exif.tobytes())
+        result = image_transform(data, 'image/jpeg')
+        self.assertEqual(Image.open(BytesIO(result)).size, (50, 100))
+
+        # the original data when the new image is not smaller
+        data = image_data((10, 10), 'PNG', optimize=True)
+        self.assertEqual(image_transform(data, 'image/png', 50), data)
+
+    def test_outbox(self):
+        'Test outbox enqueue, pending and drain of the read rows'
+        from trytond.modules.magento_product import product as product_module
+        Outbox = product_module.MagentoProductOutbox
+        magento = mock.Mock(id=1, esale_shop_app='magento')
+        other = mock.Mock(id=2, esale_shop_app='other')
+        products = [mock.Mock(id=i, template=mock.Mock(shops=[magento, other]))
+            for i in (10, 11)]
+        deleted = []
+
+        with mock.patch.object(product_module, 'Transaction') as Transaction, \
+                mock.patch.object(Outbox, 'create', create=True) as create, \
+                mock.patch.object(Outbox, '__table__', create=True), \
+                mock.patch.object(product_module, 'reduce_ids',
+                    side_effect=lambda column, ids: (
+                        deleted.extend(ids) or mock.MagicMock())):
+            Transaction.return_value.context = {}
+            Outbox.enqueue(products + products[:1], ['product'])
+            create.assert_called_once_with([
+                    {'shop': 1, 'product': 10, 'kind': 'product'},
+                    {'shop': 1, 'product': 11, 'kind': 'product'},
+                    ])
+
+            # changes of the exports are not enqueued
+            create.reset_mock()
+            Transaction.return_value.context = {'magento_outbox': False}
+            Outbox.enqueue(products)
+            create.assert_not_called()
+
+            cursor = Transaction.return_value.connection.cursor.return_value
+            cursor.fetchall.return_value = [(3, 10), (4, 11), (7, 10)]
+            product_ids, outbox_ids = Outbox.pending(magento, 'product')
+            self.assertEqual(product_ids, [10, 11])
+            self.assertEqual(outbox_ids, [3, 4, 7])
+
+            # only the rows read are removed
+            cursor.execute.reset_mock()
+            Outbox.drain(magento, 'product', outbox_ids)
+            self.assertEqual(deleted, [3, 4, 7])
+            cursor.execute.reset_mock()
+            Outbox.drain(magento, 'product', [])
+            cursor.execute.assert_not_called()
+
+
 def suite():
     suite = trytond.tests.test_tryton.suite()
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
         MagentoProductTestCase))
-    return suite
\ No newline at end of file
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        MagentoProductToolsTestCase))
+    return suite
@@ -0,0 +1,370 @@
+# This file is part magento_product module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+from trytond.config import config as config_
+from magento.api import API
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+from xmlrpc.client import Fault
+from io import BytesIO
+import hashlib
+import json
+import threading
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+MAX_CONNECTIONS = config_.getint('magento', 'max_connections', default=50)
+DOWNLOAD_WORKERS = config_.getint('magento', 'download_workers', default=10)
+DOWNLOAD_TIMEOUT = config_.getint('magento', 'download_timeout', default=60)
+_SESSION_EXPIRED = 5
+PRODUCT_NOT_EXISTS = 101
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+class MagentoSession(object):
+    '''
+    Authenticated XML-RPC client of Magento. Used as the client of the
+    magento API classes: calls use the current session and login again when
+    Magento returns the session is expired.
+    '''
+
+    def __init__(self, uri, username, password):
+        api = API(uri, username, password)
+        api.connect()
+        self.server = api.client
+        self.username = username
+        self.password = password
+        self.session = self.server.login(username, password)
+
+    def _retry(self, func):
+        try:
+            return func(self.session)
+        except Fault as e:
+            if e.faultCode != _SESSION_EXPIRED:
+                raise
+            self.session = self.server.login(self.username, self.password)
+            return func(self.session)
+
+    def call(self, session, resource_path, arguments):
+        return self._retry(
+            lambda session: self.server.call(session, resource_path, arguments))
+
+    def multiCall(self, session, calls):
+        return self._retry(
+            lambda session: self.server.multiCall(session, calls))
+
+    def endSession(self, session):
+        try:
+            self.server.endSession(self.session)
+        except Exception:
+            pass
+
+
+class MagentoSessionPool(object):
+    '''
+    Pool of Magento sessions of an URI and user. A session is used by one
+    thread at a time and it is kept to be reused by next calls, export
+    phases and runs. Up to size sessions are in use at a time (of all the
+    threads and nested stages): next calls wait for a free session, so a
+    thread must not ask for a second session while it uses one.
+    '''
+
+    def __init__(self, uri, username, password, size=None):
+        self.uri = uri
+        self.username = username
+        self.password = password
+        self.size = size or MAX_CONNECTIONS
+        self.idle = []
+        self.lock = threading.Lock()
+        self.semaphore = threading.BoundedSemaphore(self.size)
+
+    @contextmanager
+    def api(self, api_class):
+        '''
+        Magento API (Product, Category,...) with a session of the pool
+        :param api_class: magento API class
+        '''
+        with self.semaphore:
+            with self.lock:
+                session = self.idle.pop() if self.idle else None
+            if session is None:
+                session = MagentoSession(self.uri, self.username,
+                    self.password)
+            api = api_class(self.uri, self.username, self.password)
+            api.client = session
+            api.session = session.session
+            try:
+                yield api
+            finally:
+                with self.lock:
+                    if len(self.idle) < self.size:
+                        self.idle.append(session)
+                        session = None
+                if session:
+                    session.endSession(session.session)
+
+
+def magento_shared_api(api, api_class):
+    '''
+    Magento API of api_class that uses the session of api (the calls run in
+    the same Magento session, not in a new session of the pool)
+    :param api: magento API
+    :param api_class: magento API class (ProductConfigurable,...)
+    '''
+    shared = api_class(api.url, api.username, api.password, full_url=True)
+    shared.client = api.client
+    shared.session = api.session
+    return shared
+
+
+def magento_session_pool(uri, username, password):
+    '''
+    Session pool of an URI and user (shared by all threads)
+    '''
+    key = (uri, username, password)
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+        if pool is None:
+            pool = _POOLS[key] = MagentoSessionPool(uri, username, password)
+        return pool
+
+
+def magento_api(app, api_class):
+    '''
+    Magento API with a pooled session of the app. Use it as a context
+    manager (like the magento API classes):
+        with magento_api(app, Product) as product_api:
+    :param app: object
+    :param api_class: magento API class (Product, Category,...)
+    '''
+    return magento_session_pool(app.uri, app.username, app.password).api(
+        api_class)
+
+
+def magento_imap(app, api_class, func, items, workers=None, window=None):
+    '''
+    Call func(api, item) for each item in a pool of threads and yield the
+    results in the items order. Every call uses a session of the app
+    session pool.
+    Calls run ahead of the consumer up to window items, so the caller could
+    save to Tryton while next items are fetched.
+    Never use Tryton records or Transaction inside func.
+    :param app: object
+    :param api_class: magento API class (Product, Category,...)
+    :param func: function(api, item)
+    :param items: iterable
+    :param workers: int (default max_connections)
+    :param window: int (default two calls by worker)
+    '''
+    workers = workers or MAX_CONNECTIONS
+    window = window or workers * 2
+    sessions = magento_session_pool(app.uri, app.username, app.password)
+
+    def call(item):
+        with sessions.api(api_class) as api:
+            return func(api, item)
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(call, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+class ByteSemaphore(object):
+    '''
+    Bound the bytes in use across threads: acquire(size) waits until size
+    bytes are free. A size greater than the bound waits for the whole bound
+    (it runs alone).
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.free = size
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        size = min(size, self.size)
+        with self.condition:
+            while self.free < size:
+                self.condition.wait()
+            self.free -= size
+        return size
+
+    def release(self, size):
+        with self.condition:
+            self.free += size
+            self.condition.notify_all()
+
+    @contextmanager
+    def reserve(self, size):
+        '''
+        Use size bytes inside the with block
+        :param size: int
+        '''
+        size = self.acquire(size)
+        try:
+            yield
+        finally:
+            self.release(size)
+
+
+def chunks(iterable, size):
+    '''
+    Split an iterable (or generator) in lists of size items
+    :param iterable: iterable
+    :param size: int
+    '''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def magento_multicall(api, calls, size=None):
+    '''
+    Send Magento calls in multiCall requests of size calls (one request by
+    call when size is lower than 2). An error of a call does not stop the
+    next calls.
+    :param api: magento API
+    :param calls: list of tuples (resource path, arguments)
+    :param size: int
+    :return: list of tuples (ok, result or error), same order. Errors are
+        the exception (Fault of the call in multiCall requests)
+    '''
+    results = []
+    if not size or size < 2:
+        for resource_path, arguments in calls:
+            try:
+                results.append((True, api.call(resource_path,
+                            list(arguments))))
+            except Exception as e:
+                results.append((False, e))
+        return results
+
+    for chunk in chunks(calls, size):
+        try:
+            responses = api.multiCall([[resource_path, list(arguments)]
+                    for resource_path, arguments in chunk])
+        except Exception as e:
+            results.extend((False, e) for _ in chunk)
+            continue
+        for response in responses:
+            if isinstance(response, dict) and response.get('isFault'):
+                results.append((False, Fault(response.get('faultCode'),
+                            response.get('faultMessage'))))
+            else:
+                results.append((True, response))
+    return results
+
+
+def fault_code(error):
+    '''
+    Magento fault code of an error (None when it is not a fault)
+    :param error: exception
+    '''
+    if isinstance(error, Fault):
+        try:
+            return int(error.faultCode)
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+def magento_download(url, etag=None, last_modified=None, timeout=None):
+    '''
+    Download an url with a conditional request (ETag and Last-Modified of
+    the previous download)
+    :param url: str
+    :param etag: str
+    :param last_modified: str
+    :param timeout: int seconds (default download_timeout)
+    :return: tuple (data or None when not modified, etag, last modified)
+    '''
+    request = Request(url)
+    if etag:
+        request.add_header('If-None-Match', etag)
+    if last_modified:
+        request.add_header('If-Modified-Since', last_modified)
+    try:
+        with urlopen(request, timeout=timeout or DOWNLOAD_TIMEOUT) as response:
+            return (response.read(), response.headers.get('ETag'),
+                response.headers.get('Last-Modified'))
+    except HTTPError as e:
+        if e.code == 304:
+            return None, etag, last_modified
+        raise
+
+
+def fingerprint(values):
+    '''
+    Digest of values (dict, list or scalar) to compare payloads between runs
+    :param values: JSON serializable values (others are converted to str)
+    :return: str
+    '''
+    data = json.dumps(values, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def changed_values(values, digests):
+    '''
+    Values with a digest different from the last digests
+    :param values: dict
+    :param digests: dict key: digest (last values)
+    :return: tuple (dict changed values, dict key: digest of values)
+    '''
+    new_digests = dict((k, fingerprint(v)[:12]) for k, v in values.items())
+    changed = dict((k, v) for k, v in values.items()
+        if digests.get(k) != new_digests[k])
+    return changed, new_digests
+
+
+def image_transform(data, mime, max_dimension=None, quality=None):
+    '''
+    Resize an image to a max dimension (width or height) and encode it again
+    (JPEG with quality or optimized PNG), with the EXIF orientation
+    applied. Require Pillow.
+    :param data: bytes
+    :param mime: str (image/jpeg or image/png)
+    :param max_dimension: int (pixels)
+    :param quality: int (JPEG quality 1-95)
+    :return: bytes (original data when the new image is not smaller)
+    '''
+    if Image is None:
+        raise ImportError('Pillow is required to transform images')
+    image = Image.open(BytesIO(data))
+    # apply the EXIF orientation (camera images): EXIF is not saved
+    rotated = image.getexif().get(0x0112, 1) != 1
+    image = ImageOps.exif_transpose(image)
+    resized = False
+    if max_dimension and max(image.size) > max_dimension:
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        resized = True
+    output = BytesIO()
+    if mime == 'image/png':
+        image.save(output, 'PNG', optimize=True)
+    else:
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.save(output, 'JPEG', quality=quality or 85, optimize=True)
+    result = output.getvalue()
+    if not resized and not rotated and len(result) >= len(data):
+        return data
+    return result